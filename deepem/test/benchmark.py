@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def bench_normalize(args):
+    """Per-slice histogram normalization of a random uint8 volume."""
+    from deepem.test.utils import normalize_per_slice
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=args.shape, dtype=np.uint8)
+    print("shape: {}, threads: {}".format(img.shape, args.num_threads))
+
+    elapsed = list()
+    for _ in range(args.repeat):
+        t0 = time.time()
+        normalize_per_slice(img, lowerfract=args.lowerfract,
+                            upperfract=args.upperfract,
+                            num_threads=args.num_threads, inplace=True)
+        elapsed.append(time.time() - t0)
+    t = min(elapsed)
+    print("Elapsed: %.3f s (%.1f MB/s)" % (t, img.nbytes/t/2**20))
+
+
+def bench_write(args):
+    """
+    HDF5 output: contiguous `emio.imsave`-style write vs. chunked writes,
+    aligned to the scan stride, with each compression.
+    """
+    import h5py
+    import tempfile
+    from deepem.test import fwd_utils
+    from deepem.test.writer import write_chunked
+
+    # Smooth probability maps, like network outputs
+    rng = np.random.default_rng(0)
+    c, z, y, x = args.shape
+    data = rng.random((c, z//2 + 1, y//16 + 1, x//16 + 1), dtype=np.float32)
+    data = data.repeat(2, axis=1).repeat(16, axis=2).repeat(16, axis=3)
+    data = data[:,:z,:y,:x] + 0.02*rng.random((c, z, y, x), dtype=np.float32)
+    data = fwd_utils.quantize(np.clip(data, 0, 1), args.dtype)
+    print("shape: {}, dtype: {}, {:.1f} MB".format(data.shape, data.dtype,
+                                                  data.nbytes/2**20))
+
+    chunks = (1,) + tuple(args.stride)
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp:
+        for compress in [None] + args.compress:
+            fpath = os.path.join(tmp, 'out.h5')
+            t0 = time.time()
+            if compress is None:
+                with h5py.File(fpath, 'w') as f:
+                    f.create_dataset('/main', data=data)
+                name = 'contiguous'
+            else:
+                try:
+                    write_chunked(fpath, data, chunks, compress=compress,
+                                  num_threads=args.num_threads)
+                except ImportError as e:
+                    print("{}: {}".format(compress, e))
+                    continue
+                name = 'chunked ' + compress
+            t = time.time() - t0
+            size = os.path.getsize(fpath)
+            with h5py.File(fpath, 'r') as f:
+                assert np.array_equal(f['/main'][...], data)
+            args_ = (name, t, data.nbytes/t/2**20, size/2**20, data.nbytes/size)
+            print("%-16s %.3f s (%.1f MB/s), %.1f MB (%.2fx)" % args_)
+            os.remove(fpath)
+
+
+def bench_forward(args):
+    """
+    Sweep forward-scan configurations on --dummy input. Each configuration
+    runs in its own process, so that peak RSS is per configuration.
+    """
+    # Sweep axes: (name, [(value, test options)])
+    axes = [('device', [(d, ['--cpu'] if d == 'cpu' else []) for d in args.device]),
+            ('threads', [(n, []) for n in args.threads]),
+            ('tta', [(n, tta_options(n)) for n in args.tta])]
+    for sweep in args.sweep or []:
+        key, values = sweep[0], sweep[1:]
+        axes.append((key, [(v, sweep_options(key, v)) for v in values]))
+
+    base = ['--exp_name', 'benchmark', '--dummy', '--model', args.model,
+            '--fov'] + [','.join(str(x) for x in args.fov)]
+    base += ['--dummy_inputsz'] + [str(x) for x in args.dummy_inputsz]
+    base += shlex.split(args.opts)
+
+    results = list()
+    for config in itertools.product(*[values for _, values in axes]):
+        params = {name: v for (name, _), (v, _) in zip(axes, config)}
+        argv = base + [x for _, options in config for x in options]
+        cmd = [sys.executable, '-m', 'deepem.test.benchmark', 'run',
+               '--threads', str(params['threads']), '--warmup', str(args.warmup),
+               '--argv', json.dumps(argv)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if proc.returncode == 0:
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+        else:
+            error = proc.stderr.strip().splitlines()
+            result = dict(error=error[-1] if error else proc.returncode)
+        result = dict(params, **result)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    with (open(args.out, 'w') if args.out else contextlib.nullcontext(sys.stdout)) as f:
+        if args.format == 'json':
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        else:
+            fields = list()
+            for r in results:
+                fields += [k for k in r if k not in fields]
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def tta_options(num_aug):
+    if num_aug > 1:
+        return ['--test_aug'] + [str(i) for i in range(num_aug)]
+    return []
+
+
+def sweep_options(key, value):
+    """Test options for a swept value; on/off toggles a flag."""
+    if value == 'on':
+        return ['--' + key]
+    if value == 'off':
+        return []
+    return ['--' + key] + value.split()
+
+
+def run_forward(args):
+    """Run one forward-scan configuration and print its JSON report."""
+    import torch
+    from deepem.test.forward import Forward
+    from deepem.test.option import Options
+    from deepem.test.utils import load_model, make_forward_scanner
+
+    torch.set_num_threads(args.threads)
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        opt = Options().parse(json.loads(args.argv))
+        if not opt.cpu:
+            torch.backends.cudnn.benchmark = not opt.no_autotune
+        model = load_model(opt)
+        forward = Forward(opt)
+        for _ in range(args.warmup):
+            forward(model, make_forward_scanner(opt, data_name='dummy'))
+
+        scanner = make_forward_scanner(opt, data_name='dummy')
+        t0 = time.time()
+        forward(model, scanner)
+        if not opt.cpu:
+            torch.cuda.synchronize()
+        elapsed = time.time() - t0
+
+    # Volume-level TTA scans the volume once per augmentation.
+    num_scans = len(opt.test_aug) if opt.test_aug and not opt.patch_aug else 1
+    voxels = int(scanner.voxels()) * num_scans
+    result = dict(voxels=voxels, elapsed=elapsed,
+                  voxels_per_sec=voxels/elapsed,
+                  peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+    if not opt.cpu:
+        result['peak_gpu_mb'] = torch.cuda.max_memory_allocated()/2**20
+    # Per-stage timing (of the last scan)
+    for k, v in forward.elapsed.items():
+        result[k + '_total'] = sum(v)
+        result[k + '_per_batch'] = sum(v)/len(v) if v else 0.
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    # Histogram normalization
+    p = subparsers.add_parser('normalize')
+    p.add_argument('--shape', type=int, default=[100,4096,4096], nargs=3)
+    p.add_argument('--lowerfract', type=float, default=0.01)
+    p.add_argument('--upperfract', type=float, default=0.01)
+    p.add_argument('--num_threads', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=1)
+    p.set_defaults(func=bench_normalize)
+
+    # HDF5 output writing
+    p = subparsers.add_parser('write')
+    p.add_argument('--shape', type=int, default=[3,64,1024,1024], nargs=4)
+    p.add_argument('--dtype', default='float32')
+    p.add_argument('--stride', type=int, default=[10,128,128], nargs=3)
+    p.add_argument('--compress', default=['none','gzip','lz4','zstd'], nargs='+')
+    p.add_argument('--num_threads', type=int, default=4)
+    p.add_argument('--tmp_dir', default=None)
+    p.set_defaults(func=bench_write)
+
+    # Forward scan sweep
+    models = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'models')
+    p = subparsers.add_parser('forward')
+    p.add_argument('--model', default=os.path.join(models, 'rsunet.py'))
+    p.add_argument('--fov', type=int, default=[20,256,256], nargs=3)
+    p.add_argument('--dummy_inputsz', type=int, default=[40,512,512], nargs=3)
+    p.add_argument('--device', default=['cpu'], nargs='+')  # 'cpu'/'gpu'
+    p.add_argument('--threads', type=int, default=[1], nargs='+')
+    p.add_argument('--tta', type=int, default=[1], nargs='+')
+    p.add_argument('--sweep', action='append', nargs='+',
+                   help="test option and its values, e.g. "
+                        "--sweep batch_size 1 4 --sweep width '16 32 64'")
+    p.add_argument('--opts', default='', help="common test options")
+    p.add_argument('--warmup', type=int, default=1)
+    p.add_argument('--format', default='json', choices=['json','csv'])
+    p.add_argument('--out', default=None)
+    p.set_defaults(func=bench_forward)
+
+    # Single forward-scan configuration (used by 'forward')
+    p = subparsers.add_parser('run')
+    p.add_argument('--argv', required=True)
+    p.add_argument('--threads', type=int, default=1)
+    p.add_argument('--warmup', type=int, default=1)
+    p.set_defaults(func=run_forward)
+
+    args = parser.parse_args()
+    args.func(args)
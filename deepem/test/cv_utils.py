@@ -15,12 +15,40 @@ def make_info(num_channels, layer_type, dtype, shape, resolution,
 
 
 def cutout(opt, gs_path, dtype='uint8'):
+    cvol, sl = open_cutout(opt, gs_path)
+    cutout = cvol[sl]
+
+    # Transpose & squeeze
+    cutout = cutout.transpose([3,2,1,0])
+    cutout = np.squeeze(cutout).astype(dtype)
+    return cutout
+
+
+def cutout_slab(cvol, sl, z0, z1, dtype='uint8'):
+    """Cut out z-sections [z0, z1) of the bbox `sl` (relative to its start)."""
+    zs = slice(sl[2].start + z0, sl[2].start + z1)
+    cutout = cvol[sl[0],sl[1],zs]
+
+    # Transpose & squeeze channel
+    cutout = cutout.transpose([3,2,1,0])
+    assert cutout.shape[0] == 1
+    return cutout[0].astype(dtype)
+
+
+def cutout_shape(sl):
+    """Shape (z,y,x) of the bbox `sl`."""
+    return tuple(s.stop - s.start for s in reversed(sl[:3]))
+
+
+def open_cutout(opt, gs_path, mip=None):
+    """CloudVolume and the requested bbox in its mip coordinates."""
+    mip = opt.in_mip if mip is None else mip
     if '{}' in gs_path:
         gs_path = gs_path.format(*opt.keywords)
     print(gs_path)
 
     # CloudVolume.
-    cvol = cv.CloudVolume(gs_path, mip=opt.in_mip, cache=opt.cache,
+    cvol = cv.CloudVolume(gs_path, mip=mip, cache=opt.cache,
                           fill_missing=True, parallel=opt.parallel)
 
     # Cutout
@@ -44,22 +72,123 @@ def cutout(opt, gs_path, dtype='uint8'):
     # Coordinates
     print('mip 0 = {}'.format(sl))
     sl = cvol.slices_from_global_coords(sl)
-    print('mip {} = {}'.format(opt.in_mip, sl))
-    cutout = cvol[sl]
-
-    # Transpose & squeeze
-    cutout = cutout.transpose([3,2,1,0])
-    cutout = np.squeeze(cutout).astype(dtype)
-    return cutout
+    print('mip {} = {}'.format(mip, sl))
+    return cvol, sl
 
 
 def ingest(data, opt, tag=None):
-    # Neuroglancer format
     data = py_utils.to_tensor(data)
-    data = data.transpose((3,2,1,0))
-    num_channels = data.shape[-1]
-    shape = data.shape[:-1]
+    writer = make_writer(opt, data.shape, str(data.dtype), tag=tag)
+    writer.write((0,0,0), data)
+    writer.close()
+
 
+def make_writer(opt, shape, dtype, tag=None):
+    """
+    Create an output layer of `shape` (c,z,y,x), and its `CloudWriter`.
+    With --downsample, the layer has --num_mips lower mips.
+    """
+    shape = tuple(int(x) for x in shape)
+    offset = get_offset(opt)
+    num_mips = opt.num_mips if opt.downsample else 0
+    gs_path = create_layer(opt, shape[0], dtype, shape[:0:-1], offset,
+                           tag=tag, num_mips=num_mips)
+    return CloudWriter(gs_path, shape, opt, num_mips=num_mips)
+
+
+class CloudWriter(object):
+    """
+    Upload output blocks to a layer as soon as they fill whole chunks.
+
+    Blocks must come in z order and span the whole layer in-plane, as
+    written by `scanner.SlabBlender`. They are buffered until they reach
+    the next chunk boundary in z, and then uploaded in neuroglancer order
+    through a strided view (no transposed copy). The lower mips are
+    downsampled (2x2x1 averaging) from the same in-memory blocks, so the
+    freshly written mip 0 is never read back.
+    """
+    def __init__(self, gs_path, shape, opt, num_mips=0):
+        """
+        Args:
+            gs_path:  Layer path (any CloudVolume protocol, e.g. file://).
+            shape:    Output shape (c,z,y,x).
+            num_mips: Number of lower mips to write.
+        """
+        self.shape = tuple(shape)
+        self.cvols = [cv.CloudVolume(gs_path, mip=mip, parallel=opt.parallel)
+                      for mip in range(num_mips + 1)]
+        self.chunk_z = int(self.cvols[0].underlying[2])
+        self.blocks = list()
+        self.z = 0  # First buffered section
+        self.end = 0  # End of buffered sections
+
+    def write(self, begin, data):
+        """Write a 4D block whose first voxel is at `begin` (z,y,x)."""
+        assert begin[0] == self.end, "blocks must be written in z order"
+        assert tuple(begin[1:]) == (0,0)
+        assert data.shape[-2:] == self.shape[-2:]
+        self.blocks.append(data)
+        self.end += data.shape[-3]
+
+        # Upload whole chunks.
+        z1 = (self.end // self.chunk_z) * self.chunk_z
+        if self.end == self.shape[-3]:
+            z1 = self.end
+        if z1 > self.z:
+            self.upload(self.take(z1))
+
+    def close(self):
+        assert self.end == self.shape[-3], "unfinished layer"
+        assert not self.blocks
+
+    def take(self, z1):
+        """Take buffered sections [self.z, z1)."""
+        n = z1 - self.z
+        if self.blocks[0].shape[-3] < n:
+            self.blocks = [np.concatenate(self.blocks, axis=-3)]
+        data = self.blocks[0][:,:n,...]
+        rest = self.blocks[0][:,n:,...]
+        self.blocks = ([rest] if rest.shape[-3] > 0 else []) + self.blocks[1:]
+        z0, self.z = self.z, z1
+        return z0, data
+
+    def upload(self, block):
+        z0, data = block
+        for mip, cvol in enumerate(self.cvols):
+            bounds = cvol.bounds
+            if mip > 0:
+                offset = self.cvols[mip-1].bounds.minpt[:2]
+                data = downsample_xy(data, offset)
+            # Downsampled layers are floor(offset/2) + ceil(size/2) in size.
+            data = data[..., :bounds.size3()[1], :bounds.size3()[0]]
+            x0, y0, zmin = bounds.minpt
+            x1, y1, _ = bounds.maxpt
+            zs = slice(zmin + z0, zmin + z0 + data.shape[-3])
+            cvol[x0:x1, y0:y1, zs] = data.transpose((3,2,1,0))
+
+
+def downsample_xy(data, offset):
+    """
+    2x2x1 average of a (c,z,y,x) block whose in-plane origin is `offset`
+    (x,y), on the global grid of 2x2 pixels, over the pixels in the block.
+    """
+    c, z, y, x = data.shape
+    px, py = int(offset[0]) % 2, int(offset[1]) % 2
+    Y, X = (py + y + 1)//2, (px + x + 1)//2
+    acc = np.zeros((c, z, 2*Y, 2*X), dtype=np.float32)
+    cnt = np.zeros((2*Y, 2*X), dtype=np.float32)
+    acc[..., py:py+y, px:px+x] = data
+    cnt[py:py+y, px:px+x] = 1
+    acc = acc.reshape(c, z, Y, 2, X, 2).sum(axis=(3,5))
+    cnt = cnt.reshape(Y, 2, X, 2).sum(axis=(1,3))
+    acc /= cnt
+    if np.issubdtype(data.dtype, np.integer):
+        acc = np.round(acc)
+    return acc.astype(data.dtype)
+
+
+def get_offset(opt):
+    """Voxel offset of the output layer."""
     # Offset
     if opt.offset is None:
         opt.offset = opt.begin
@@ -74,12 +203,10 @@ def ingest(data, opt, tag=None):
 
     # Patch offset correction (when output patch is smaller than input patch)
     patch_offset = (np.array(opt.inputsz) - np.array(opt.outputsz)) // 2
-    offset = tuple(np.array(offset) + np.flip(patch_offset, 0))
+    return tuple(np.array(offset) + np.flip(patch_offset, 0))
 
-    # Create info
-    info = make_info(num_channels, 'image', str(data.dtype), shape,
-                     opt.resolution, offset=offset, chunk_size=opt.chunk_size)
-    print(info)
+
+def get_gs_path(opt, tag=None):
     gs_path = opt.gs_output
     if '{}' in opt.gs_output:
         if opt.keywords:
@@ -99,18 +226,38 @@ def ingest(data, opt, tag=None):
         else:
             gs_path += ('/' + tag)
 
+    return gs_path
+
+
+def create_layer(opt, num_channels, dtype, shape, offset, tag=None,
+                 num_mips=0):
+    """Create an output layer (and its lower mips) and return its path."""
+    info = make_info(num_channels, 'image', dtype, shape, opt.resolution,
+                     offset=offset, chunk_size=opt.chunk_size)
+    print(info)
+    gs_path = get_gs_path(opt, tag=tag)
     print("gs_output:\n{}".format(gs_path))
-    cvol = cv.CloudVolume(gs_path, mip=0, info=info,
-                          parallel=opt.parallel)
-    cvol[:,:,:,:] = data
+    cvol = cv.CloudVolume(gs_path, mip=0, info=info, parallel=opt.parallel)
+    for mip in range(1, num_mips + 1):
+        cvol.add_scale((2**mip, 2**mip, 1), chunk_size=opt.chunk_size)
     cvol.commit_info()
+    return gs_path
+
+
+def write(data, gs_path, begin, opt):
+    """Write a 4D (c,z,y,x) block at `begin` (x,y,z) of an existing layer."""
+    data = py_utils.to_tensor(data)
+    data = data.transpose((3,2,1,0))
+    end = tuple(b + s for b, s in zip(begin, data.shape[:3]))
+    cvol = cv.CloudVolume(gs_path, mip=0, parallel=opt.parallel)
+    cvol[begin[0]:end[0],begin[1]:end[1],begin[2]:end[2]] = data
+
 
-    # Downsample
-    if opt.downsample:
-        import igneous
-        from igneous.task_creation import create_downsampling_tasks
+def downsample(gs_path, opt):
+    import igneous
+    from igneous.task_creation import create_downsampling_tasks
 
-        with LocalTaskQueue(parallel=opt.parallel) as tq:
-            # create_downsampling_tasks(tq, gs_path, mip=0, fill_missing=True)
-            tasks = create_downsampling_tasks(gs_path, mip=0, fill_missing=True)
-            tq.insert_all(tasks)
+    with LocalTaskQueue(parallel=opt.parallel) as tq:
+        # create_downsampling_tasks(tq, gs_path, mip=0, fill_missing=True)
+        tasks = create_downsampling_tasks(gs_path, mip=0, fill_missing=True)
+        tq.insert_all(tasks)
@@ -0,0 +1,44 @@
+import os
+
+import torch
+
+from deepem.test.option import Options
+from deepem.test.utils import get_infer_fpath
+
+
+def export(opt):
+    """
+    Strip a training checkpoint down to what inference needs: the model
+    weights (optionally in half precision) and the model spec. The result
+    is saved next to the checkpoint and preferred by `load_chkpt`.
+    """
+    fpath = os.path.join(opt.model_dir, "model{}.chkpt".format(opt.chkpt_num))
+    chkpt = torch.load(fpath, map_location='cpu')
+    # Backward compatibility
+    state_dict = chkpt['state_dict'] if 'state_dict' in chkpt else chkpt
+
+    dtype = torch.float16 if opt.export_half else torch.float32
+    weights = dict()
+    for k, v in state_dict.items():
+        weights[k] = v.to(dtype) if v.is_floating_point() else v
+        weights[k] = weights[k].contiguous()
+
+    spec = dict(model=opt.model, in_spec=opt.in_spec, out_spec=opt.out_spec,
+                inputsz=opt.inputsz, outputsz=opt.outputsz, fov=opt.fov,
+                depth=opt.depth, width=opt.width, group=opt.group, act=opt.act)
+    infer = {'iter': opt.chkpt_num, 'state_dict': weights,
+             'dtype': str(dtype), 'spec': spec}
+
+    fname = get_infer_fpath(opt.model_dir, opt.chkpt_num)
+    torch.save(infer, fname)
+    print("EXPORT: {} ({:.1f} MB) -> {} ({:.1f} MB)".format(
+        fpath, os.path.getsize(fpath)/2**20, fname, os.path.getsize(fname)/2**20))
+
+
+if __name__ == "__main__":
+    # Options
+    opt = Options().parse()
+    assert opt.chkpt_num > 0
+
+    # Export an inference checkpoint.
+    export(opt)
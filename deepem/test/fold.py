@@ -0,0 +1,71 @@
+import torch
+from torch import nn
+from torch import fx
+
+
+def fold_batchnorm(model):
+    """
+    Fold eval-mode batch normalization into the 3D convolution that feeds
+    it.
+
+    Matching follows the dataflow of the network (`model.model`), traced
+    symbolically with torch.fx: a BatchNorm3d is folded if its input is the
+    output of a Conv3d that has no other users (e.g. not also a residual
+    or skip connection). Pairs across module boundaries, such as the input
+    convolution and the first pre-activation BN of an RSUNet core, are
+    found as well. Folded layers are replaced by `nn.Identity`.
+
+    Returns the number of folded layers (0 if the network can't be traced).
+    """
+    net = model.model
+    try:
+        graph = LeafTracer().trace(net)
+    except Exception as e:
+        print("FOLD: cannot trace the network ({}: {})".format(type(e).__name__, e))
+        return 0
+
+    modules = dict(net.named_modules())
+    count = 0
+    for node in graph.nodes:
+        if node.op != 'call_module':
+            continue
+        bn = modules[node.target]
+        if not (isinstance(bn, nn.BatchNorm3d) and bn.track_running_stats):
+            continue
+        src = node.args[0] if node.args else None
+        if not (isinstance(src, fx.Node) and src.op == 'call_module'):
+            continue
+        conv = modules[src.target]
+        if not isinstance(conv, nn.Conv3d) or len(src.users) != 1:
+            continue
+        if bn.num_features != conv.out_channels:
+            continue
+        fold_bn(conv, bn)
+        parent, _, name = node.target.rpartition('.')
+        setattr(net.get_submodule(parent), name, nn.Identity())
+        count += 1
+    return count
+
+
+class LeafTracer(fx.Tracer):
+    """
+    Tracer that keeps parameter-free modules (e.g. `Crop`, whose forward
+    depends on tensor shapes) opaque; they contain no convolution or
+    normalization to fold.
+    """
+    def is_leaf_module(self, m, qualname):
+        if super(LeafTracer, self).is_leaf_module(m, qualname):
+            return True
+        return next(m.parameters(), None) is None
+
+
+@torch.no_grad()
+def fold_bn(conv, bn):
+    assert bn.num_features == conv.out_channels
+    std = torch.sqrt(bn.running_var + bn.eps)
+    gamma = bn.weight if bn.affine else torch.ones_like(std)
+    beta = bn.bias if bn.affine else torch.zeros_like(std)
+    scale = gamma / std
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(std)
+    conv.weight.mul_(scale.reshape(-1, 1, 1, 1, 1))
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + beta)
@@ -1,4 +1,6 @@
 import numpy as np
+import queue
+import threading
 import time
 
 import torch
@@ -6,6 +8,7 @@ import torch
 from dataprovider3 import Dataset, ForwardScanner
 
 from deepem.test import fwd_utils
+from deepem.test.scanner import BlockScanner, crop_locs
 
 
 class Forward(object):
@@ -18,28 +21,54 @@ class Forward(object):
         self.out_spec = dict(opt.out_spec)
         self.scan_spec = dict(opt.scan_spec)
         self.scan_params = dict(opt.scan_params)
+        self.batch_size = opt.batch_size
+        self.pipeline = opt.pipeline
+        self.queue_size = opt.queue_size
+        self.lock = threading.Lock()
         self.test_aug = opt.test_aug
+        self.patch_aug = opt.patch_aug
+        self.device_blend = opt.device_blend
+        self.bf16 = (opt.precision == 'bf16')
+        self.skip_empty = opt.skip_empty
+        self.crop_border = opt.crop_border
+        self.crop_center = opt.crop_center
+        self.zeros = dict()
         self.variance = opt.variance
         self.precomputed = (opt.blend == 'precomputed')
 
-    def __call__(self, model, scanner):
+        # Precomputed mask of reverted per-patch augmentations
+        self.blend_mask = dict()
+        if self.patch_aug and self.precomputed:
+            from deepem.test.model import blend_masks
+            for k, v in blend_masks(opt).items():
+                self.blend_mask[k] = v[0].cpu().numpy()
+
+    def __call__(self, model, scanner, mask=None):
+        """
+        Args:
+            model:   Inference model.
+            scanner: Forward scanner.
+            mask:    Optional `volume.CoarseMask` of the scanned volume,
+                     used to skip masked-out patches with --skip_empty.
+        """
         dataset = scanner.dataset
+        self.mask = None
+        self.keep = None
 
         # Test-time augmentation
-        if self.test_aug:
+        if self.test_aug and not self.patch_aug:
 
-            # For variance computation
+            # For streaming variance computation
             if self.variance:
                 aug_out = dict()
                 for k, v in scanner.outputs.data.items():
-                    aug_out[k] = list()
+                    aug_out[k] = fwd_utils.RunningVariance()
             else:
                 aug_out = None
 
             count = 0.0
             for aug in self.test_aug:
-                # dec2bin
-                rule = np.array([int(x) for x in bin(aug)[2:].zfill(4)])
+                rule = fwd_utils.get_rule(aug)
                 print("Test-time augmentation {}".format(rule))
 
                 # Augment dataset.
@@ -63,7 +92,7 @@ class Forward(object):
 
                     # For variance computation
                     if self.variance:
-                        aug_out[k].append(reverted)
+                        aug_out[k].update(reverted)
 
                 count += 1
 
@@ -77,6 +106,22 @@ class Forward(object):
 
             return (scanner.outputs, aug_out)
 
+        # Coarse mask of the (unaugmented) scanned volume
+        self.mask = mask
+
+        # Patches overlapping the final crop (BlockScanner scans only those)
+        crop = self.crop_border or self.crop_center
+        if crop and not isinstance(scanner, BlockScanner):
+            self.keep = set(crop_locs(scanner.locs, self.scan_spec,
+                                      self.crop_border, self.crop_center))
+
+        # Per-patch test-time augmentation
+        if self.patch_aug:
+            self.rules = [fwd_utils.get_rule(aug) for aug in self.test_aug]
+            self.counts = dict()
+            for rule in self.rules:
+                print("Test-time augmentation {}".format(rule))
+
         return (self.forward(model, scanner), None)
 
     ####################################################################
@@ -84,45 +129,262 @@ class Forward(object):
     ####################################################################
 
     def forward(self, model, scanner):
-        elapsed = list()
+        self.elapsed = {k: list() for k in ['pull','compute','push']}
+        self.skipped = 0
         t0 = time.time()
         with torch.no_grad():
-            inputs = scanner.pull()
-            while inputs:
-                inputs = self.to_torch(inputs)
+            if self.pipeline:
+                self.forward_pipelined(model, scanner)
+            else:
+                self.forward_sequential(model, scanner)
+        self.report(scanner, time.time() - t0)
+        return scanner.outputs
 
-                # Forward pass
-                outputs = model(inputs)
-                scanner.push(self.from_torch(outputs))
+    def forward_sequential(self, model, scanner):
+        inputs = self.prefetch(scanner)
+        while inputs is not None:
+            outputs = self.compute(model, inputs)
+            self.blend(scanner, outputs)
+            inputs = self.prefetch(scanner)
 
-                # Elapsed time
-                elapsed.append(time.time() - t0)
-                print("Elapsed: %.3f s" % elapsed[-1])
-                t0 = time.time()
+    def forward_pipelined(self, model, scanner):
+        """
+        Run prefetch, compute and blend as separate stages joined by
+        bounded queues. Prefetch and blend run on background threads,
+        while compute runs on the calling thread.
+        """
+        inputs_q = queue.Queue(maxsize=self.queue_size)
+        outputs_q = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = list()
 
-                # Fetch next inputs
-                inputs = scanner.pull()
+        def prefetch():
+            try:
+                inputs = self.prefetch(scanner)
+                while inputs is not None:
+                    if not put(inputs_q, inputs, stop):
+                        return
+                    inputs = self.prefetch(scanner)
+                put(inputs_q, None, stop)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
 
-        print("Elapsed: %.3f s/patch" % (sum(elapsed)/len(elapsed)))
-        print("Throughput: %d voxel/s" % round(scanner.voxels()/sum(elapsed)))
-        return scanner.outputs
+        def blend():
+            try:
+                outputs = get(outputs_q, stop)
+                while outputs is not None:
+                    self.blend(scanner, outputs)
+                    outputs = get(outputs_q, stop)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        threads = [threading.Thread(target=prefetch, daemon=True),
+                   threading.Thread(target=blend, daemon=True)]
+        for t in threads:
+            t.start()
+
+        try:
+            inputs = get(inputs_q, stop)
+            while inputs is not None:
+                if not put(outputs_q, self.compute(model, inputs), stop):
+                    break
+                inputs = get(inputs_q, stop)
+            put(outputs_q, None, stop)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+
+        if errors:
+            raise errors[0]
+
+    def prefetch(self, scanner):
+        """Pull stage: scanner pull & host-to-device copy."""
+        t0 = time.time()
+        batch = self.pull(scanner)
+        if not batch:
+            return None
+        locs, samples = zip(*batch)
+        inputs = self.to_torch(samples)
+        self.elapsed['pull'].append(time.time() - t0)
+        return (locs, inputs)
+
+    def compute(self, model, inputs):
+        """Compute stage: forward pass & device-to-host copy."""
+        t0 = time.time()
+        locs, inputs = inputs
+        with fwd_utils.autocast(self.device, enabled=self.bf16):
+            outputs = self.from_torch(model(inputs))
+        self.elapsed['compute'].append(time.time() - t0)
+        print("Elapsed: %.3f s" % self.elapsed['compute'][-1])
+        return (locs, outputs)
 
-    def to_torch(self, sample):
+    def blend(self, scanner, outputs):
+        """Push stage: output blending."""
+        t0 = time.time()
+        locs, outputs = outputs
+        if self.patch_aug:
+            outputs = self.revert(outputs)
+        for loc, output in zip(locs, outputs):
+            self.push(scanner, loc, output)
+        self.elapsed['push'].append(time.time() - t0)
+
+    def report(self, scanner, total):
+        print("Batch size: %d" % self.batch_size)
+        for k, v in self.elapsed.items():
+            if v:
+                args = (k, sum(v)/len(v), sum(v))
+                print("Elapsed (%s): %.3f s/batch, %.3f s total" % args)
+        print("Elapsed: %.3f s" % total)
+        print("Throughput: %d voxel/s" % round(scanner.voxels()/total))
+        if self.keep is not None:
+            args = (len(self.keep), len(scanner.locs))
+            print("Within crop: %d/%d patches" % args)
+        if self.skip_empty:
+            voxels = scanner.voxels() * self.skipped // len(scanner.locs)
+            args = (self.skipped, len(scanner.locs), voxels)
+            print("Skipped: %d/%d patches, %d voxels" % args)
+
+    def pull(self, scanner):
+        """Pull up to `batch_size` samples along with their scan locations."""
+        batch = list()
+        while len(batch) < self.batch_size:
+            with self.lock:
+                sample = scanner.pull()
+                if not sample:
+                    break
+                # Blend zeros outside the final crop.
+                loc = tuple(int(x) for x in scanner.current)
+                if self.keep is not None and loc not in self.keep:
+                    self.skip(scanner)
+                    continue
+                # Blend empty patches without running the model.
+                if self.skip_empty and self.is_empty(scanner.current, sample):
+                    self.skipped += 1
+                    self.skip(scanner)
+                    continue
+                batch.append((scanner.current, sample))
+                # Detach the location so that the next sample can be pulled.
+                scanner.current = None
+        return batch
+
+    def is_empty(self, loc, sample):
+        """
+        A patch is empty if the coarse mask has no valid voxel in it, or
+        if its input is all zero (e.g. masked out by --gs_input_mask, or a
+        missing section).
+        """
+        if self.mask is not None:
+            fovs = [np.array(self.in_spec[k][-3:]) for k in sample]
+            begin = np.array(loc) - np.max(fovs, axis=0)//2
+            end = begin + np.max(fovs, axis=0)
+            if self.mask.empty(begin, end):
+                return True
+        return not any(np.any(v) for v in sample.values())
+
+    def skip(self, scanner):
+        """Blend zeros at the current scan location."""
+        if isinstance(scanner, BlockScanner):
+            scanner.skip()
+            return
+        sample = dict()
+        for k, v in self.scan_spec.items():
+            if k not in self.zeros:
+                self.zeros[k] = np.zeros(v[-4:], dtype=np.float32)
+            sample[k] = self.zeros[k]
+        scanner.push(sample)
+
+    def push(self, scanner, loc, sample):
+        with self.lock:
+            scanner.current = loc
+            scanner.push(sample)
+
+    def to_torch(self, samples):
         inputs = dict()
         for k in sorted(self.in_spec):
-            data = np.expand_dims(sample[k], axis=0)
-            tensor = torch.from_numpy(data)
+            data = [sample[k] for sample in samples]
+            # Per-patch test-time augmentation
+            if self.patch_aug:
+                data = [fwd_utils.flip(x, rule=r) for x in data for r in self.rules]
+            tensor = torch.from_numpy(np.stack(data))
             inputs[k] = tensor.to(self.device)
         return inputs
 
     def from_torch(self, outputs):
         ret = dict()
-        for k in sorted(self.out_spec):
-            if k in self.scan_spec:
-                scan_channels = self.scan_spec[k][-4]
-                narrowed = outputs[k].narrow(1, 0, scan_channels)
-                ret[k] = np.squeeze(narrowed.cpu().numpy(), axis=(0,))
+        for k in sorted(self.scan_spec):
+            if k in outputs:
+                # Already narrowed to the scan channels by Model.
+                output = outputs[k].float()
+                # Device-side blending keeps outputs on the device.
+                ret[k] = output if self.device_blend else output.cpu().numpy()
+        # Split into per-sample outputs.
+        batch_size = len(next(iter(ret.values())))
+        return [{k: v[i] for k, v in ret.items()} for i in range(batch_size)]
+
+    def revert(self, outputs):
+        """
+        Revert per-patch test-time augmentation and average the variants
+        of each patch, then apply the precomputed mask (if any) in the
+        original frame, so that the weights of overlapping patches still
+        sum to one with asymmetric masks.
+
+        Voxels invalidated by the affinity shift in `revert_flip` are
+        excluded from the average. Unlike volume-level test-time
+        augmentation, which averages them in as zeros at the volume
+        border, they occur at every patch border here.
+        """
+        n = len(self.rules)
+        ret = list()
+        for i in range(0, len(outputs), n):
+            variants = outputs[i:i+n]
+            averaged = dict()
+            for k in variants[0]:
+                dst = (1,1,1) if k == 'affinity' else None
+                total = np.zeros_like(variants[0][k])
+                for rule, output in zip(self.rules, variants):
+                    total += fwd_utils.revert_flip(output[k], rule=rule, dst=dst)
+                averaged[k] = total / self.count(k, total.shape)
+                if k in self.blend_mask:
+                    averaged[k] *= self.blend_mask[k]
+            ret.append(averaged)
         return ret
 
+    def count(self, key, shape):
+        """Number of valid variants per voxel."""
+        if (key, shape) not in self.counts:
+            dst = (1,1,1) if key == 'affinity' else None
+            count = np.zeros(shape, dtype=np.float32)
+            for rule in self.rules:
+                ones = np.ones(shape, dtype=np.float32)
+                count += fwd_utils.revert_flip(ones, rule=rule, dst=dst)
+            self.counts[(key, shape)] = np.maximum(count, 1)
+        return self.counts[(key, shape)]
+
     def make_forward_scanner(self, dataset):
         return ForwardScanner(dataset, self.scan_spec, **self.scan_params)
+
+
+def put(q, item, stop):
+    """Put an item into a bounded queue unless the pipeline has stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(q, stop):
+    """Get an item from a queue, or None if the pipeline has stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
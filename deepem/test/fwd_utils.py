@@ -1,5 +1,8 @@
 import numpy as np
 
+import torch
+from torch.nn import functional as F
+
 from deepem.utils import py_utils
 
 
@@ -37,6 +40,11 @@ class Flip(object):
 flip = Flip()
 
 
+def get_rule(aug):
+    """Decode a test-time augmentation ID into a transform rule (dec2bin)."""
+    return np.array([int(x) for x in bin(aug)[2:].zfill(4)])
+
+
 def revert_flip(data, rule, dst=None):
     data = py_utils.to_tensor(data)
     assert np.size(rule)==4
@@ -97,3 +105,68 @@ def revert_flip(data, rule, dst=None):
                 data[2,-dz:,:,:].fill(0)
 
     return data
+
+
+def quantize(data, dtype):
+    """Quantize sigmoid outputs in [0,1], either numpy arrays or torch tensors.
+
+    uint8 stores round(255*p), with a maximum absolute error of 1/510;
+    values outside [0,1] are clipped. float16 has a maximum absolute
+    error of 2**-12 on [0,1].
+    """
+    assert dtype in ['float32','float16','uint8']
+    if dtype == 'float32':
+        return data
+    if torch.is_tensor(data):
+        if dtype == 'uint8':
+            return data.clamp(0,1).mul(255).round().to(torch.uint8)
+        return data.to(torch.float16)
+    # Already quantized
+    if data.dtype == dtype:
+        return data
+    if dtype == 'uint8':
+        return np.round(np.clip(data,0,1) * 255).astype('uint8')
+    return data.astype('float16')
+
+
+def autocast(device, enabled=True):
+    """bfloat16 autocast on the device."""
+    device_type = torch.device(device).type
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=enabled)
+
+
+class RunningVariance(object):
+    """
+    Streaming mean/variance accumulation (Welford's algorithm).
+
+    Keeps two buffers (running mean and M2) no matter how many samples
+    are accumulated.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data):
+        self.count += 1
+        if self.mean is None:
+            self.mean = np.array(data, dtype=np.float32)
+            self.m2 = np.zeros_like(self.mean)
+            return
+        delta = data - self.mean
+        self.mean += delta / self.count
+        delta *= data - self.mean
+        self.m2 += delta
+
+    def variance(self):
+        """Population variance, equivalent to np.var(..., axis=0)."""
+        assert self.count > 0
+        return self.m2 / self.count
+
+
+def upsample(data, scale_factor):
+    """Trilinear upsampling of a (c,z,y,x) array, as `nn.Upsample`."""
+    x = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+    x = F.interpolate(x[None], scale_factor=tuple(float(s) for s in scale_factor),
+                      mode='trilinear')
+    return x[0].numpy()
@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 
 """
@@ -5,159 +7,139 @@ Adapted from https://github.com/seung-lab/chunkflow/.
 """
 
 class PatchMask(np.ndarray):
-    def __new__(cls, patch_size, overlap):
+    def __new__(cls, patch_size, overlap, cache_dir=None):
         assert len(patch_size) == 3
         assert len(overlap) == 3
 
-        mask = make_mask(patch_size, overlap)
+        key = mask_key(patch_size, overlap)
+        build = lambda: make_mask(patch_size, overlap)
+        mask = load_mask(key, build, cache_dir=cache_dir)
         return np.asarray(mask).view(cls)
 
 
 class AffinityMask(np.ndarray):
-    def __new__(cls, patch_size, overlap, edges, bump):
+    def __new__(cls, patch_size, overlap, edges, bump, cache_dir=None):
         assert len(patch_size) == 3
         assert len(overlap) == 3
         assert len(edges) > 0
         assert bump in ['zung','wu', 'wu_no_crust']
 
-        masks = list()
-        for edge in edges:
-            mask = make_mask(patch_size, overlap, edge=edge, bump=bump)
-            masks.append(mask)
-        mask = np.stack(masks)
+        def build():
+            mask = np.empty((len(edges),) + tuple(patch_size), dtype=np.float32)
+            for i, edge in enumerate(edges):
+                mask[i] = make_mask(patch_size, overlap, edge=edge, bump=bump)
+            return mask
+
+        key = mask_key(patch_size, overlap, edges=edges, bump=bump)
+        mask = load_mask(key, build, cache_dir=cache_dir)
         return np.asarray(mask).view(cls)
 
 
+def mask_key(patch_size, overlap, edges=None, bump='zung'):
+    key = 'patch{}_overlap{}'.format(*['x'.join(str(int(v)) for v in t)
+                                       for t in (patch_size, overlap)])
+    if edges is not None:
+        key += '_edges' + '_'.join('x'.join(str(int(v)) for v in e) for e in edges)
+    return key + '_' + bump
+
+
+def load_mask(key, build, cache_dir=None):
+    """Load a mask from `cache_dir`, or build (and cache) it."""
+    if cache_dir is None:
+        return build()
+    fpath = os.path.join(cache_dir, key + '.npy')
+    if os.path.exists(fpath):
+        return np.load(fpath)
+    mask = build()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp = '{}.{}.tmp.npy'.format(fpath[:-4], os.getpid())
+    np.save(tmp, mask)
+    os.replace(tmp, fpath)
+    return mask
+
+
 def make_mask(patch_size, overlap, edge=None, bump='zung'):
-    # Stride
-    stride = tuple(p - o for p, o in zip(patch_size, overlap))
-
-    # Offsets of the 3x3x3 grid
-    offsets = list()
-    for z in range(3):
-        for y in range(3):
-            for x in range(3):
-                offsets.append((z,y,x))
-
-    # Slices
-    slices = list()
-    for offset in offsets:
-        s = tuple(slice(o*s,o*s+p) for o,s,p in zip(offset,stride,patch_size))
-        slices.append(s)
-
-    # Shape of the 3x3x3 overlapping grid
-    shape = tuple(f + 2*s for f, s in zip(patch_size, stride))
-    base_mask = np.zeros(shape, dtype=np.float64)
+    """
+    Blending weight of a patch, normalized over the 3x3x3 grid of patches
+    overlapping it.
+
+    Every bump is a product of per-axis bumps (the zung bump is the
+    exponential of a sum of per-axis logits), and so is its normalization
+    over the grid. The weight is thus the outer product of per-axis
+    weights, each normalized over a 1D grid of 3 patches.
+    """
+    if edge is None:
+        edge = (0,0,0)
+    assert len(edge) == 3
+
+    weights = list()
+    for p, o, e in zip(patch_size, overlap, edge):
+        w = make_axis_mask(p, p - o, e, bump=bump)
+        weights.append(np.asarray(w, dtype=np.float32))
+    wz, wy, wx = weights
+    return wz[:,None,None] * wy[None,:,None] * wx[None,None,:]
+
+
+def make_axis_mask(size, stride, edge=0, bump='zung'):
+    """1D normalized blending weight along an axis."""
+    # Slices of the 1D grid of 3 overlapping patches
+    slices = [slice(o*stride, o*stride + size) for o in range(3)]
+    shape = size + 2*stride
+    center = slices[1]
+    emap = mask_edge(np.ones(size, dtype=np.float64), edge=edge)
 
     if bump == 'zung':
 
         # Max logit
         max_logit = np.full(shape, -np.inf, dtype=np.float64)
-        logit = bump_logit_map(patch_size)
+        logit = bump_logit(size)
         for s in slices:
             max_logit[s] = np.maximum(max_logit[s], logit)
 
         # Mask
+        base_mask = np.zeros(shape, dtype=np.float64)
         for s in slices:
-            base_mask[s] += bump_map(logit, max_logit[s], edge=edge)
+            base_mask[s] += np.exp(logit - max_logit[s]) * emap
 
         # Normalized weight
-        s = tuple(slice(s,s+p) for s,p in zip(stride,patch_size))
-        weight = bump_map(logit, max_logit[s], edge=edge) / base_mask[s]
+        bmap = np.exp(logit - max_logit[center]) * emap
 
-    elif bump == 'wu':
+    elif bump in ['wu', 'wu_no_crust']:
 
-        # Mask
-        bmap = bump_map_wu(patch_size, edge=edge)
-        for s in slices:
-            base_mask[s] += bmap
-
-        # Normalized weight
-        s = tuple(slice(s,s+p) for s,p in zip(stride,patch_size))
-        weight = bmap / base_mask[s]
+        bmap = bump_wu(size) * emap
 
-    elif bump == 'wu_no_crust':
+        # Ignore the "crust"
+        if bump == 'wu_no_crust':
+            bmap[[0,-1]] = 0
 
         # Mask
-        bmap = bump_map_wu_no_crust(patch_size, edge=edge)
+        base_mask = np.zeros(shape, dtype=np.float64)
         for s in slices:
             base_mask[s] += bmap
 
-        # Normalized weight
-        s = tuple(slice(s,s+p) for s,p in zip(stride,patch_size))
-        weight = bmap / base_mask[s]
-
     else:
         assert False
 
-    return np.asarray(weight, dtype=np.float32)
-
-
-def bump_logit(z, y, x, t=1.5):
-    return -(x*(1-x))**(-t)-(y*(1-y))**(-t)-(z*(1-z))**(-t)
-
-
-def bump_logit_map(patch_size):
-    x = range(patch_size[-1])
-    y = range(patch_size[-2])
-    z = range(patch_size[-3])
-    zv, yv, xv = np.meshgrid(z, y, x, indexing='ij')
-    xv = (xv + 1.0)/(patch_size[-1] + 1.0)
-    yv = (yv + 1.0)/(patch_size[-2] + 1.0)
-    zv = (zv + 1.0)/(patch_size[-3] + 1.0)
-    return np.asarray(bump_logit(zv, yv, xv), dtype=np.float64)
-
-
-def mask_edge(weight, edge=None):
-    if edge is not None:
-        assert len(edge) == 3
-        z, y, x = edge
-        assert abs(x) < weight.shape[-1]
-        if x > 0:
-            weight[:,:,:x] = 0
-        elif x < 0:
-            weight[:,:,x:] = 0
-        assert abs(y) < weight.shape[-2]
-        if y > 0:
-            weight[:,:y,:] = 0
-        elif y < 0:
-            weight[:,y:,:] = 0
-        assert abs(z) < weight.shape[-3]
-        if z > 0:
-            weight[:z,:,:] = 0
-        elif z < 0:
-            weight[z:,:,:] = 0
-    return weight
+    return bmap / base_mask[center]
 
 
-def bump_map(logit, max_logit, edge=None):
-    weight = np.exp(logit - max_logit)
-    return mask_edge(weight, edge=edge)
+def bump_logit(size, t=1.5):
+    x = (np.arange(size) + 1.0)/(size + 1.0)
+    return -(x*(1-x))**(-t)
 
 
-def bump_map_wu(patch_size, edge=None):
+def bump_wu(size):
     """Wu blending"""
-    x = range(patch_size[-1])
-    y = range(patch_size[-2])
-    z = range(patch_size[-3])
-    zv, yv, xv = np.meshgrid(z, y, x, indexing='ij')
-    xv = (xv + 1.0)/(patch_size[-1] + 1.0) * 2.0 - 1.0
-    yv = (yv + 1.0)/(patch_size[-2] + 1.0) * 2.0 - 1.0
-    zv = (zv + 1.0)/(patch_size[-3] + 1.0) * 2.0 - 1.0
-    weight = np.exp(-1.0/(1.0 - xv*xv) +
-                    -1.0/(1.0 - yv*yv) +
-                    -1.0/(1.0 - zv*zv))
-    weight = mask_edge(weight, edge=edge)
-    return np.asarray(weight, dtype=np.float64)
-
-
-def bump_map_wu_no_crust(patch_size, edge=None):
-    """Wu blending with crust suppressed"""
-    weight = bump_map_wu(patch_size, edge=edge)
-
-    # Ignore the "crust"
-    weight[[0,-1],:,:] = 0
-    weight[:,[0,-1],:] = 0
-    weight[:,:,[0,-1]] = 0
+    x = (np.arange(size) + 1.0)/(size + 1.0) * 2.0 - 1.0
+    return np.exp(-1.0/(1.0 - x*x))
+
 
+def mask_edge(weight, edge=0):
+    """Zero out the first (edge > 0) or last (edge < 0) |edge| voxels."""
+    assert abs(edge) < weight.shape[-1]
+    if edge > 0:
+        weight[:edge] = 0
+    elif edge < 0:
+        weight[edge:] = 0
     return weight
@@ -17,6 +17,7 @@ class Model(nn.Module):
         self.device = opt.device
         self.model = model
         self.in_spec = dict(opt.in_spec)
+        self.out_spec = dict(opt.out_spec)
         self.scan_spec = dict(opt.scan_spec)
         self.pretrain = opt.pretrain
         self.force_crop = opt.force_crop
@@ -27,37 +28,29 @@ class Model(nn.Module):
         else:
             self.temperature = max(opt.temperature, 1.0)
 
-        # Precomputed mask
+        # Precomputed mask (applied by `Forward` after reverting per-patch
+        # test-time augmentation)
         self.mask = dict()
-        if opt.blend == 'precomputed':
-            for k, v in opt.scan_spec.items():
-                patch_sz = v[-3:]
-                if k == 'affinity':
-                    edges = opt.mask_edges
-                    mask = AffinityMask(patch_sz, opt.overlap, edges, opt.bump)
-                else:
-                    mask = PatchMask(patch_sz, opt.overlap)
-                    mask = np.expand_dims(mask, axis=0)
-                mask = np.expand_dims(mask, axis=0)
-                self.mask[k] = torch.from_numpy(mask).to(opt.device)
+        if opt.blend == 'precomputed' and not opt.patch_aug:
+            self.mask = blend_masks(opt)
 
     def forward(self, sample):
         inputs = [sample[k] for k in sorted(self.in_spec)]
         preds = self.model(*inputs)
         outputs = dict()
         for k, x in preds.items():
+            # Narrowing (before the elementwise sigmoid)
+            output_channels = x.shape[-4]
+            scan_channels = self.scan_spec[k][-4]
+            assert output_channels >= scan_channels
+            if output_channels > scan_channels:
+                x = x.narrow(-4, 0, scan_channels)
+
             if self.temperature is None:
                 outputs[k] = torch.sigmoid(x)
             else:
                 outputs[k] = torch.sigmoid(x/self.temperature)
 
-            # Narrowing
-            output_channels = outputs[k].shape[-4]
-            scan_channels = self.scan_spec[k][-4]
-            assert output_channels >= scan_channels
-            if output_channels > scan_channels:
-                outputs[k] = outputs[k].narrow(-4, 0, scan_channels)
-
             # Precomputed mask
             if k in self.mask:
                 outputs[k] *= self.mask[k]
@@ -74,6 +67,23 @@ class Model(nn.Module):
         chkpt = torch.load(fpath, map_location=map_location)
         # Backward compatibility
         state_dict = chkpt['state_dict'] if 'state_dict' in chkpt else chkpt
+        self.load_weights(state_dict)
+
+    def load_inference(self, fpath):
+        """Load an inference checkpoint (see `test/export.py`), memory-mapped."""
+        chkpt = torch.load(fpath, map_location='cpu', mmap=True, weights_only=True)
+        spec = chkpt['spec']
+        # Keys & channels must match (patch sizes may differ, e.g. --fov).
+        for name in ['in_spec','out_spec']:
+            exported = {k: tuple(v[:-3]) for k, v in spec[name].items()}
+            expected = {k: tuple(v[:-3]) for k, v in getattr(self, name).items()}
+            if exported != expected:
+                raise ValueError("{} mismatch: {} exported, {} expected".format(
+                                 name, spec[name], getattr(self, name)))
+        # Half-precision weights are cast back by load_state_dict.
+        self.load_weights(chkpt['state_dict'])
+
+    def load_weights(self, state_dict):
         if self.pretrain:
             model_dict = self.model.state_dict()
             state_dict = {k:v for k, v in state_dict.items() if k in model_dict}
@@ -81,3 +91,57 @@ class Model(nn.Module):
             self.model.load_state_dict(model_dict)
         else:
             self.model.load_state_dict(state_dict)
+
+
+class Ensemble(nn.Module):
+    """
+    Ensemble of inference models, averaged patch by patch so that input
+    I/O and blending happen once for all models.
+    """
+    def __init__(self, models, opt):
+        super(Ensemble, self).__init__()
+        self.models = nn.ModuleList(models)
+        self.variance = opt.ensemble_var
+        self.mask = dict()
+        if opt.blend == 'precomputed' and self.variance:
+            self.mask = blend_masks(opt)
+
+    def forward(self, sample):
+        preds = [model(sample) for model in self.models]
+        outputs = dict()
+        for k in preds[0]:
+            x = torch.stack([p[k] for p in preds])
+            outputs[k] = x.mean(dim=0)
+
+            # Optional per-model variance
+            if self.variance:
+                var = x.var(dim=0, unbiased=False)
+                # Members' outputs are already multiplied by the precomputed
+                # mask m, which scales their variance by m**2 instead of m.
+                if k in self.mask:
+                    m = self.mask[k]
+                    var = torch.where(m > 0, var/m.clamp(min=1e-30),
+                                      torch.zeros_like(var))
+                outputs[k + '_var'] = var
+
+        return outputs
+
+
+def blend_masks(opt):
+    """Precomputed blending masks of the model outputs."""
+    masks = dict()
+    for k, v in opt.scan_spec.items():
+        if k not in opt.out_spec:
+            continue  # Not a model output (e.g. ensemble variance)
+        patch_sz = v[-3:]
+        if k == 'affinity':
+            edges = opt.mask_edges
+            mask = AffinityMask(patch_sz, opt.overlap, edges, opt.bump,
+                                cache_dir=opt.mask_cache)
+        else:
+            mask = PatchMask(patch_sz, opt.overlap,
+                             cache_dir=opt.mask_cache)
+            mask = np.expand_dims(mask, axis=0)
+        mask = np.expand_dims(mask, axis=0)
+        masks[k] = torch.from_numpy(mask).to(opt.device)
+    return masks
@@ -30,6 +30,10 @@ class Options(object):
         self.parser.add_argument('--model', default=None)
         self.parser.add_argument('--pretrain', action='store_true')
         self.parser.add_argument('--no_eval', action='store_true')
+        self.parser.add_argument('--no_fold', action='store_true')
+        self.parser.add_argument('--compile', default=None)  # 'trace'/'compile'
+        self.parser.add_argument('--precision', default='fp32')  # 'fp32'/'bf16'/'int8'
+        self.parser.add_argument('--calib_patches', type=int, default=8)
         self.parser.add_argument('--inputsz', type=vec3, default=None)
         self.parser.add_argument('--outputsz', type=vec3, default=None)
         self.parser.add_argument('--force_crop', type=vec3, default=None)
@@ -38,6 +42,8 @@ class Options(object):
         self.parser.add_argument('--width', type=int, default=None, nargs='+')
         self.parser.add_argument('--group', type=int, default=0)
         self.parser.add_argument('--act', default='ReLU')
+        # Up/down models without down/upsampling: 'native'/'upsample' output
+        self.parser.add_argument('--working_res', default=None)
 
         # Multiclass detection
         self.parser.add_argument('--aff',  action='store_true')
@@ -56,6 +62,7 @@ class Options(object):
         # Test-time augmentation
         self.parser.add_argument('--test_aug', type=int, default=None, nargs='+')
         self.parser.add_argument('--variance', action='store_true')
+        self.parser.add_argument('--patch_aug', action='store_true')
 
         # Temperature T for softer softmax
         self.parser.add_argument('--temperature', type=float, default=None)
@@ -64,8 +71,10 @@ class Options(object):
         self.parser.add_argument('--gs_input', default='')
         self.parser.add_argument('--gs_input_mask', default='')
         self.parser.add_argument('--gs_input_norm', type=float, default=None, nargs='+')
+        self.parser.add_argument('--norm_threads', type=int, default=4)
         self.parser.add_argument('--in_mip', type=int, default=0)
         self.parser.add_argument('--cache', action='store_true')
+        self.parser.add_argument('--stream_input', action='store_true')
         self.parser.add_argument('-b','--begin', type=vec3, default=None)
         self.parser.add_argument('-e','--end', type=vec3, default=None)
         self.parser.add_argument('-c','--center', type=vec3, default=None)
@@ -77,10 +86,30 @@ class Options(object):
         self.parser.add_argument('--keywords', default=[], nargs='+')
         self.parser.add_argument('-p','--parallel', type=int, default=16)
         self.parser.add_argument('-d','--downsample', action='store_true')
+        self.parser.add_argument('--num_mips', type=int, default=5)
         self.parser.add_argument('-r','--resolution', type=vec3, default=(4,4,40))
         self.parser.add_argument('-o','--offset', type=vec3, default=None)
         self.parser.add_argument('--chunk_size', type=vec3, default=(64,64,16))
 
+        # Sharded inference (x,y,z)
+        self.parser.add_argument('--block_size', type=vec3, default=None)
+        self.parser.add_argument('--block_margin', type=vec3, default=None)
+        self.parser.add_argument('--num_workers', type=int, default=1)
+        self.parser.add_argument('--task_dir', default=None)
+
+        # Inference server
+        self.parser.add_argument('--host', default='127.0.0.1')
+        self.parser.add_argument('--port', type=int, default=8000)
+        self.parser.add_argument('--unix_socket', default=None)
+        self.parser.add_argument('--chkpt_nums', type=int, default=None, nargs='+')
+
+        # Ensemble of checkpoints ([exp_name:]chkpt_num)
+        self.parser.add_argument('--ensemble', default=None, nargs='+')
+        self.parser.add_argument('--ensemble_var', action='store_true')
+
+        # Inference checkpoint export
+        self.parser.add_argument('--export_half', action='store_true')
+
         # Data
         self.parser.add_argument('--data_dir', default="")
         self.parser.add_argument('--data_names', nargs='+')
@@ -91,14 +120,31 @@ class Options(object):
         self.parser.add_argument('--out_tag', default='')
         self.parser.add_argument('--overlap', type=vec3f, default=(0.5,0.5,0.5))
         self.parser.add_argument('--stride', type=vec3, default=None)
+        # Mirrored border; copy-free (virtual) only with block-wise scanning
+        # (--out_of_core/--stream_input/--device_blend), padded copy otherwise
         self.parser.add_argument('--mirror', type=vec3, default=None)
         self.parser.add_argument('--crop_border', type=vec3, default=None)
         self.parser.add_argument('--crop_center', type=vec3, default=None)
         self.parser.add_argument('--blend', default='bump')
         self.parser.add_argument('--bump', default='zung')  # 'zung'/'wu'/'wu_no_crust'
+        self.parser.add_argument('--batch_size', type=int, default=1)
+        self.parser.add_argument('--pipeline', action='store_true')
+        self.parser.add_argument('--queue_size', type=int, default=2)
+        self.parser.add_argument('--pipeline_io', action='store_true')
+        self.parser.add_argument('--out_of_core', action='store_true')
+        self.parser.add_argument('--device_blend', action='store_true')
+        # Quantized output: 'uint8' (max abs error 1/510) or 'float16' (2**-12)
+        self.parser.add_argument('--out_dtype', default='float32')
+        self.parser.add_argument('--skip_empty', action='store_true')
+        # Chunked HDF5 output: 'gzip', 'lz4' or 'zstd', with optional ':level'
+        self.parser.add_argument('--h5_chunked', action='store_true')
+        self.parser.add_argument('--h5_compress', default=None)
+        self.parser.add_argument('--h5_threads', type=int, default=4)
+        self.parser.add_argument('--skip_mip', type=int, default=None)
 
         # Asymmetric mask
         self.parser.add_argument('--mask_edges', type=vec3, default=[(0,0,1),(0,1,0),(1,0,0)], nargs='+')
+        self.parser.add_argument('--mask_cache', default=None)
 
         # Benchmark
         self.parser.add_argument('--dummy', action='store_true')
@@ -106,19 +152,16 @@ class Options(object):
 
         self.initialized = True
 
-    def parse(self):
+    def parse(self, args=None):
         if not self.initialized:
             self.initialize()
-        opt = self.parser.parse_args()
+        opt = self.parser.parse_args(args)
 
         # Device
         opt.device = 'cpu' if opt.cpu else 'cuda'
 
         # Directories
-        if opt.exp_name.split('/')[0] == 'experiments':
-            opt.exp_dir = opt.exp_name
-        else:
-            opt.exp_dir = 'experiments/{}'.format(opt.exp_name)
+        opt.exp_dir = self.get_exp_dir(opt.exp_name)
         opt.model_dir = os.path.join(opt.exp_dir, 'models')
         opt.fwd_dir = os.path.join(opt.exp_dir, 'forward')
 
@@ -188,6 +231,89 @@ class Options(object):
             # infer overlap from stride
             opt.overlap = tuple(int(f-s) for f,s in zip(opt.outputsz, opt.stride))
         opt.scan_params = dict(stride=opt.stride, blend=opt.blend)
+        assert opt.batch_size > 0
+        assert opt.compile in [None, 'trace', 'compile']
+        assert opt.precision in ['fp32','bf16','int8']
+        if opt.precision == 'int8':
+            assert opt.cpu, "--precision int8 is for CPU inference"
+            assert opt.data_names, "--precision int8 calibrates on --data_names"
+            assert not opt.no_eval
+        assert opt.queue_size > 0
+        if opt.pipeline_io:
+            assert opt.data_names, "--pipeline_io overlaps --data_names"
+
+        # Per-patch test-time augmentation
+        if opt.patch_aug:
+            assert opt.test_aug, "--patch_aug requires --test_aug"
+            assert not opt.variance, "--variance is not supported with --patch_aug"
+            if any(aug & 1 for aug in opt.test_aug):
+                # xy-transpose must preserve the patch shape.
+                assert opt.inputsz[-1] == opt.inputsz[-2]
+                assert opt.outputsz[-1] == opt.outputsz[-2]
+
+        # Sharded inference
+        if opt.block_margin is None:
+            opt.block_margin = tuple(reversed(opt.outputsz))
+        assert opt.num_workers > 0
+
+        # Inference server
+        if opt.chkpt_nums is None:
+            opt.chkpt_nums = [opt.chkpt_num]
+
+        # Ensemble of checkpoints
+        if opt.ensemble:
+            members = list()
+            for member in opt.ensemble:
+                exp_name, _, chkpt_num = member.rpartition(':')
+                exp_dir = self.get_exp_dir(exp_name) if exp_name else opt.exp_dir
+                members.append((os.path.join(exp_dir, 'models'), int(chkpt_num)))
+            opt.ensemble = members
+            if opt.ensemble_var:
+                assert not opt.test_aug, "--ensemble_var does not support --test_aug"
+                for k, v in list(opt.scan_spec.items()):
+                    opt.scan_spec[k + '_var'] = v
+        else:
+            assert not opt.ensemble_var, "--ensemble_var requires --ensemble"
+
+        # Up/down models at their working resolution (see test/utils.py)
+        opt.working_factor = None
+        if opt.working_res:
+            assert opt.working_res in ['native','upsample']
+            if opt.working_res == 'upsample':
+                assert not opt.gs_input, \
+                    "--working_res upsample is for local data (use native)"
+
+        # Block-wise scanning
+        if opt.stream_input:
+            assert opt.gs_input, "--stream_input requires --gs_input"
+        if opt.out_of_core and not opt.gs_output:
+            assert not opt.gs_input, \
+                "--out_of_core with --gs_input requires --gs_output"
+        assert opt.out_dtype in ['float32','float16','uint8']
+        if opt.h5_compress:
+            assert opt.h5_compress.partition(':')[0] in ['none','gzip','lz4','zstd']
+            opt.h5_chunked = True
+        assert opt.h5_threads > 0
+        assert opt.norm_threads > 0
+        if opt.skip_mip is not None:
+            assert opt.skip_empty and opt.gs_input_mask, \
+                "--skip_mip requires --skip_empty and --gs_input_mask"
+            assert opt.skip_mip >= opt.in_mip
+        if opt.device_blend:
+            assert not opt.patch_aug, "--device_blend does not support --patch_aug"
+        opt.block_scan = opt.out_of_core or opt.stream_input or opt.device_blend
+        if opt.working_res == 'upsample':
+            assert not opt.out_of_core, "--working_res upsample requires in-memory outputs"
+        # Cropped runs allocate & scan only the cropped output, if possible.
+        # (ForwardScanner, i.e. bump blending, allocates the full output.)
+        if opt.crop_border or opt.crop_center:
+            if opt.blend == 'precomputed' and (opt.patch_aug or not opt.test_aug):
+                opt.block_scan = True
+        if opt.block_scan:
+            assert opt.blend == 'precomputed', \
+                "block-wise scanning requires --blend precomputed"
+            if opt.test_aug:
+                assert opt.patch_aug, "block-wise scanning requires --patch_aug"
 
         # Output tagging
         if opt.tags is not None:
@@ -203,6 +329,11 @@ class Options(object):
         self.opt = opt
         return self.opt
 
+    def get_exp_dir(self, exp_name):
+        if exp_name.split('/')[0] == 'experiments':
+            return exp_name
+        return 'experiments/{}'.format(exp_name)
+
     def get_overlap(self, fov, overlap):
         assert len(fov) == 3
         assert len(overlap) == 3
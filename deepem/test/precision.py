@@ -0,0 +1,131 @@
+import copy
+import keyword
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from deepem.test import fwd_utils
+from deepem.test.utils import read_input
+
+
+def reduce_precision(model, opt):
+    """
+    Reduced-precision inference model (--precision).
+
+    bf16:   bfloat16 autocast (applied by `Forward`), model unchanged.
+    int8:   Static post-training quantization of the network (FX graph
+            mode), calibrated on --calib_patches random patches from
+            --data_names. The output head stays in float32.
+
+    Both are compared against float32 on as many held-out patches, if
+    --data_names are given (bf16 needs no calibration and skips the report
+    otherwise).
+    """
+    if opt.precision == 'bf16' and not opt.data_names:
+        return model
+
+    samples = calibration_samples(opt, 2*opt.calib_patches)
+    calib, held_out = samples[::2], samples[1::2]
+
+    reduced = model
+    if opt.precision == 'int8':
+        reduced = quantize_int8(model, calib)
+
+    report_error(model, reduced, held_out, bf16=(opt.precision == 'bf16'))
+    return reduced
+
+
+def calibration_samples(opt, num_samples):
+    """Random input patches from --data_names."""
+    rng = np.random.RandomState(0)
+    imgs = [read_input(opt, dname) for dname in opt.data_names]
+    samples = list()
+    for i in range(num_samples):
+        img = imgs[i % len(imgs)]
+        sample = dict()
+        for k, v in opt.in_spec.items():
+            fov = v[-3:]
+            begin = [rng.randint(0, s - f + 1) for s, f in zip(img.shape, fov)]
+            patch = img[tuple(slice(b, b + f) for b, f in zip(begin, fov))]
+            patch = np.ascontiguousarray(patch)[np.newaxis,np.newaxis]
+            sample[k] = torch.from_numpy(patch).to(opt.device)
+        samples.append(sample)
+    return samples
+
+
+def quantize_int8(model, samples):
+    """Quantize `model.model` (the network) to int8, keeping the head."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    inputs = lambda sample: [sample[k] for k in sorted(model.in_spec)]
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+
+    print("INT8 QUANTIZATION: {} calibration patches".format(len(samples)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        quantized = copy.deepcopy(model)
+        rename_keywords(quantized.model)
+        prepared = prepare_fx(quantized.model, qconfig_mapping,
+                              tuple(inputs(samples[0])),
+                              prepare_custom_config=custom_config(quantized.model))
+        with torch.no_grad():
+            for sample in samples:
+                prepared(*inputs(sample))
+        quantized.model = convert_fx(prepared)
+    return quantized
+
+
+def rename_keywords(net):
+    """
+    FX generates code with attribute access to submodules, which fails for
+    children named after Python keywords (e.g. the `in` block of RSUNet).
+    Rename them in place; `nn.Sequential` calls its children by order, not
+    by name.
+    """
+    for m in net.modules():
+        if isinstance(m, torch.nn.Sequential) and any(map(keyword.iskeyword, m._modules)):
+            m._modules = type(m._modules)(
+                (k + '_' if keyword.iskeyword(k) else k, v)
+                for k, v in m._modules.items())
+
+
+def custom_config(net):
+    """
+    Parameter-free custom modules (e.g. `Crop`, whose forward depends on
+    tensor shapes) are not traced symbolically.
+    """
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    classes = {type(m) for m in net.modules()
+               if not type(m).__module__.startswith('torch.')
+               and next(m.parameters(), None) is None}
+    return PrepareCustomConfig().set_non_traceable_module_classes(list(classes))
+
+
+def report_error(model, reduced, samples, bf16=False):
+    """Per-key max/mean absolute error against float32, and throughput."""
+    errors = dict()
+    elapsed = {'fp32': 0.0, 'reduced': 0.0}
+    voxels = 0
+    with torch.no_grad():
+        for sample in samples:
+            t0 = time.time()
+            ref = model(sample)
+            elapsed['fp32'] += time.time() - t0
+            t0 = time.time()
+            with fwd_utils.autocast(next(iter(sample.values())).device, enabled=bf16):
+                out = reduced(sample)
+            elapsed['reduced'] += time.time() - t0
+            for k in ref:
+                err = (out[k].float() - ref[k]).abs()
+                errors.setdefault(k, list()).append((err.max().item(), err.mean().item()))
+            voxels += max(np.prod(v.shape[-3:]) for v in ref.values())
+
+    for k, v in sorted(errors.items()):
+        max_err = max(e[0] for e in v)
+        mean_err = sum(e[1] for e in v)/len(v)
+        print("{} error: max {:.3e}, mean {:.3e}".format(k, max_err, mean_err))
+    for k, v in elapsed.items():
+        print("Throughput ({}): {:d} voxel/s".format(k, int(round(voxels/v))))
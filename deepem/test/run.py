@@ -1,4 +1,6 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
@@ -16,13 +18,43 @@ def test(opt):
 
     if opt.gs_input:
         scanner = make_forward_scanner(opt)
-        output, aug_out = forward(model, scanner)
+        mask = make_skip_mask(opt)
+        output, aug_out = forward(model, scanner, mask=mask)
         save_output(output, opt, aug_out=aug_out)
     else:
-        for dname in opt.data_names:
-            scanner = make_forward_scanner(opt, data_name=dname)
+        t0 = time.time()
+        if opt.pipeline_io:
+            test_pipelined(opt, model, forward)
+        else:
+            for dname in opt.data_names:
+                scanner = make_forward_scanner(opt, data_name=dname)
+                output, _ = forward(model, scanner)
+                save_output(output, opt, data_name=dname)
+        args = (len(opt.data_names), time.time() - t0)
+        print("Elapsed (%d datasets): %.3f s end-to-end" % args)
+
+
+def test_pipelined(opt, model, forward):
+    """
+    Load dataset i+1 and save the outputs of dataset i-1 on background
+    threads while dataset i is being scanned. At most one load and one
+    save are in flight at a time.
+    """
+    dnames = opt.data_names
+    with ThreadPoolExecutor(max_workers=1) as loader, \
+         ThreadPoolExecutor(max_workers=1) as saver:
+        loading = loader.submit(make_forward_scanner, opt, data_name=dnames[0])
+        saving = None
+        for i, dname in enumerate(dnames):
+            scanner = loading.result()
+            if i + 1 < len(dnames):
+                loading = loader.submit(make_forward_scanner, opt,
+                                        data_name=dnames[i+1])
             output, _ = forward(model, scanner)
-            save_output(output, opt, data_name=dname)
+            if saving is not None:
+                saving.result()
+            saving = saver.submit(save_output, output, opt, data_name=dname)
+        saving.result()
 
 
 if __name__ == "__main__":
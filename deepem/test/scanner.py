@@ -0,0 +1,297 @@
+import bisect
+import numpy as np
+
+import torch
+
+from deepem.test import fwd_utils
+
+
+class BlockScanner(object):
+    """
+    Forward scanner that blends outputs block by block.
+
+    Scans the same grid as `dataprovider3.ForwardScanner`, in z-major
+    order, but never holds the full output volume in memory. Outputs are
+    accumulated in z-slabs, and each slab is handed to a writer as soon
+    as no future patch can touch it.
+
+    Only precomputed blending is supported, i.e. each output patch must
+    have already been multiplied by its normalized blending mask. With a
+    crop, only the patches overlapping the cropped output are scanned.
+
+    With a `device`, slabs are accumulated on that device from output
+    patches that never leave it (torch tensors), and each finished slab
+    is copied back to host memory in one contiguous transfer.
+
+    Finished slabs can be quantized to `dtype` before they are written
+    (see `fwd_utils.quantize`), which happens on the device if any.
+    """
+    def __init__(self, dataset, in_spec, scan_spec, stride, writer,
+                 crop_border=None, crop_center=None, device=None,
+                 dtype='float32'):
+        """
+        Args:
+            dataset:     Dictionary of input volumes, indexable by 3D slices.
+            in_spec:     Input spec.
+            scan_spec:   Scan spec.
+            stride:      Scan stride.
+            writer:      Callable (key, shape) -> writer with write(begin, data)
+                         and close() methods.
+            crop_border: Optional border crop applied to the output.
+            crop_center: Optional center crop applied to the output.
+            device:      Optional torch device to blend on.
+            dtype:       Output data type ('float32'/'float16'/'uint8').
+        """
+        self.dataset = dict(dataset)
+        self.in_spec = dict(in_spec)
+        self.scan_spec = dict(scan_spec)
+        self.stride = tuple(stride)
+
+        # Scan locations
+        self.locs = self.setup_locs()
+        if crop_border or crop_center:
+            self.locs = crop_locs(self.locs, self.scan_spec, crop_border,
+                                  crop_center)
+        self.counter = 0
+        self.current = None
+
+        # Outputs
+        self.outputs = BlockOutputs()
+        for k, v in self.scan_spec.items():
+            fov = np.array(v[-3:])
+            offset, shape = output_box(self.vmin, self.vmax, fov)
+            crop = crop_box(shape, crop_border, crop_center)
+            boxes = [np.array(loc) - fov//2 - offset for loc in self.locs]
+            cropsz = tuple(int(e - b) for b, e in zip(*crop))
+            blender = SlabBlender(v[-4], fov, boxes, crop,
+                                  writer(k, (v[-4],) + cropsz), device=device,
+                                  dtype=dtype)
+            self.outputs.add(k, blender, offset)
+
+    def pull(self):
+        ret = None
+        if self.counter < len(self.locs):
+            assert self.current is None
+            idx = self.counter
+            loc = self.locs[idx]
+            print("({}/{}) loc: {}".format(idx+1, len(self.locs), tuple(loc)))
+            ret = dict()
+            for k, v in self.dataset.items():
+                fov = np.array(self.in_spec[k][-3:])
+                begin = np.array(loc) - fov//2
+                slices = tuple(slice(int(b), int(b+f)) for b, f in zip(begin, fov))
+                ret[k] = np.expand_dims(v[slices], axis=0)
+            self.current = loc
+            self.counter += 1
+        return ret
+
+    def push(self, sample):
+        assert self.current is not None
+        for k, v in sample.items():
+            if k in self.outputs.data:
+                self.outputs.push(k, self.current, v)
+        self.current = None
+
+    def skip(self):
+        """Mark the current location as done without adding a patch."""
+        assert self.current is not None
+        for k in self.outputs.data:
+            self.outputs.skip(k, self.current)
+        self.current = None
+
+    def voxels(self):
+        voxels = [np.prod(v[-3:]) for v in self.scan_spec.values()]
+        return max(voxels) * len(self.locs)
+
+    def setup_locs(self):
+        """Scan grid, identical to `dataprovider3.ForwardScanner`."""
+        vmins, vmaxs = list(), list()
+        for k, v in self.dataset.items():
+            fov = np.array(self.in_spec[k][-3:])
+            dim = np.array(v.shape[-3:])
+            assert all(dim >= fov)
+            vmins.append(fov//2)
+            vmaxs.append(dim - fov + fov//2)
+        self.vmin = np.max(vmins, axis=0)
+        self.vmax = np.min(vmaxs, axis=0)
+
+        coords = list()
+        for cmin, cmax, stride in zip(self.vmin, self.vmax, self.stride):
+            assert stride > 0
+            c = list(range(int(cmin), int(cmax) + 1, int(stride)))
+            if c[-1] != cmax:
+                c.append(int(cmax))
+            coords.append(c)
+        return [(z,y,x) for z in coords[0] for y in coords[1] for x in coords[2]]
+
+
+class BlockOutputs(object):
+    """
+    Output blenders of a `BlockScanner`, keyed by output name.
+    """
+    def __init__(self):
+        self.data = dict()
+        self.offset = dict()
+
+    def add(self, key, blender, offset):
+        self.data[key] = blender
+        self.offset[key] = offset
+
+    def get_data(self, key):
+        """Output of an in-memory (`ArrayWriter`) blender."""
+        return self.data[key].writer.data
+
+    def push(self, key, loc, patch):
+        fov = np.array(patch.shape[-3:])
+        begin = np.array(loc) - fov//2 - self.offset[key]
+        self.data[key].add(begin, patch)
+
+    def skip(self, key, loc):
+        fov = self.data[key].fov
+        begin = np.array(loc) - fov//2 - self.offset[key]
+        self.data[key].skip(begin)
+
+    def close(self):
+        for v in self.data.values():
+            v.close()
+
+
+class SlabBlender(object):
+    """
+    Accumulate output patches in z-slabs.
+
+    The slab boundaries are the z-extents of all patches. A slab is final
+    once every patch overlapping it has been added, at which point its
+    cropped region is written out and its memory released.
+    """
+    def __init__(self, num_channels, fov, boxes, crop, writer, device=None,
+                 dtype='float32'):
+        self.num_channels = num_channels
+        self.crop = (np.array(crop[0]), np.array(crop[1]))
+        self.fov = np.array(fov)
+        self.writer = writer
+        self.device = device
+        self.dtype = dtype
+
+        # Slab boundaries
+        cuts = set()
+        for b in boxes:
+            cuts.update([b[0], b[0] + fov[0]])
+        self.cuts = sorted(cuts)
+
+        # Number of patches yet to be added to each slab
+        self.pending = [0] * (len(self.cuts) - 1)
+        for b in boxes:
+            for i in self.slab_range(b[0], b[0] + fov[0]):
+                self.pending[i] += 1
+
+        self.slabs = dict()
+
+    def add(self, begin, patch):
+        """Add a patch whose first voxel is at `begin`."""
+        z0 = begin[0]
+        z1 = z0 + patch.shape[-3]
+        cb, ce = self.crop
+
+        # In-plane intersection with the crop region
+        yx0 = np.maximum(begin[1:], cb[1:])
+        yx1 = np.minimum(begin[1:] + patch.shape[-2:], ce[1:])
+
+        for i in self.slab_range(z0, z1):
+            s0, s1 = self.cuts[i], self.cuts[i+1]
+            if all(yx1 > yx0) and s0 < ce[0] and s1 > cb[0]:
+                if i not in self.slabs:
+                    shape = (self.num_channels, s1 - s0) + tuple(ce[1:] - cb[1:])
+                    self.slabs[i] = self.zeros(shape)
+                src = (slice(None), slice(s0 - z0, s1 - z0),
+                       slice(yx0[0] - begin[1], yx1[0] - begin[1]),
+                       slice(yx0[1] - begin[2], yx1[1] - begin[2]))
+                dst = (slice(None), slice(None),
+                       slice(yx0[0] - cb[1], yx1[0] - cb[1]),
+                       slice(yx0[1] - cb[2], yx1[1] - cb[2]))
+                self.slabs[i][dst] += patch[src]
+            self.pending[i] -= 1
+            if self.pending[i] == 0:
+                self.flush(i)
+
+    def skip(self, begin):
+        """Account for an all-zero patch whose first voxel is at `begin`."""
+        for i in self.slab_range(begin[0], begin[0] + self.fov[0]):
+            self.pending[i] -= 1
+            if self.pending[i] == 0:
+                self.flush(i)
+
+    def flush(self, i):
+        cb, ce = self.crop
+        s0, s1 = self.cuts[i], self.cuts[i+1]
+        z0, z1 = max(s0, cb[0]), min(s1, ce[0])
+        slab = self.slabs.pop(i, None)
+        if z0 >= z1:
+            return
+        begin = (z0 - cb[0], 0, 0)
+        if slab is None:
+            # Every patch of the slab was skipped (or missed the crop region)
+            shape = (self.num_channels, z1 - z0) + tuple(ce[1:] - cb[1:])
+            data = np.zeros(shape, dtype=self.dtype)
+        else:
+            data = fwd_utils.quantize(slab[:, z0 - s0:z1 - s0, ...], self.dtype)
+            if self.device is not None:
+                data = data.cpu().numpy()
+        self.writer.write(begin, data)
+
+    def close(self):
+        assert not self.slabs, "unfinished slabs"
+        self.writer.close()
+
+    def zeros(self, shape):
+        if self.device is None:
+            return np.zeros(shape, dtype=np.float32)
+        return torch.zeros(shape, dtype=torch.float32, device=self.device)
+
+    def slab_range(self, z0, z1):
+        return range(bisect.bisect_left(self.cuts, z0),
+                     bisect.bisect_left(self.cuts, z1))
+
+
+def output_box(vmin, vmax, fov):
+    """Offset & shape of the output volume scanned by patches of `fov`."""
+    offset = np.array(vmin) - fov//2
+    shape = tuple(int(x) for x in np.array(vmax) - fov//2 + fov - offset)
+    return offset, shape
+
+
+def crop_locs(locs, scan_spec, crop_border=None, crop_center=None):
+    """
+    Scan locations whose output patch overlaps the cropped output of at
+    least one key. The other patches do not contribute to any voxel kept
+    by the crop.
+    """
+    locs = np.array(locs)
+    vmin, vmax = locs.min(axis=0), locs.max(axis=0)
+    keep = np.zeros(len(locs), dtype=bool)
+    for v in scan_spec.values():
+        fov = np.array(v[-3:])
+        offset, shape = output_box(vmin, vmax, fov)
+        cb, ce = [np.array(x) for x in crop_box(shape, crop_border, crop_center)]
+        b = locs - fov//2 - offset
+        keep |= np.all((b < ce) & (b + fov > cb), axis=1)
+    return [tuple(int(x) for x in loc) for loc in locs[keep]]
+
+
+def crop_box(shape, crop_border=None, crop_center=None):
+    """
+    Box equivalent to `py_utils.crop_border` followed by
+    `py_utils.crop_center` on a volume of the given shape.
+    """
+    begin = np.zeros(3, dtype=int)
+    end = np.array(shape[-3:])
+    if crop_border:
+        b = np.array(crop_border[-3:]) // 2
+        assert all(end - begin > 2*b)
+        begin, end = begin + b, end - b
+    if crop_center:
+        size = np.array(crop_center[-3:])
+        assert all(end - begin >= size)
+        begin = begin + (end - begin - size)//2
+        end = begin + size
+    return (tuple(begin), tuple(end))
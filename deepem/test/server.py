@@ -0,0 +1,219 @@
+import copy
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from deepem.test.forward import Forward
+from deepem.test.option import Options
+from deepem.test.utils import (load_model, make_forward_scanner, make_scanner,
+                               make_skip_mask, mirror_border, get_output,
+                               save_output)
+
+
+class InferenceService(object):
+    """
+    Keep models warm and run forward scans on request.
+
+    Models (one per --chkpt_nums) and their blending masks are built once.
+    Requests are processed one at a time.
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        self.models = dict()
+        for chkpt_num in opt.chkpt_nums:
+            model_opt = copy.copy(opt)
+            model_opt.chkpt_num = chkpt_num
+            self.models[chkpt_num] = load_model(model_opt)
+        self.forward = Forward(opt)
+        self.lock = threading.Lock()
+
+    def __call__(self, params, data=None):
+        """
+        Args:
+            params: Request parameters. `chkpt_num` selects a model (the
+                    first by default). The input is either `data`, a local
+                    `data_name`, or a bbox of --gs_input (`begin`/`end` or
+                    `center`/`size`, x/y/z, plus optional `keywords`).
+            data:   Optional preprocessed input array (z,y,x).
+
+        Returns:
+            outputs: Dictionary of outputs for `data`, otherwise None
+                     (outputs are saved as by `run.py`).
+            elapsed: Elapsed time per step.
+        """
+        opt = copy.copy(self.opt)
+        opt.chkpt_num = params.get('chkpt_num', opt.chkpt_nums[0])
+        if opt.chkpt_num not in self.models:
+            raise KeyError("unknown chkpt_num: {}".format(opt.chkpt_num))
+        if 'begin' in params or 'end' in params:
+            opt.center = None
+        for k in ['begin','end','center','size']:
+            if k in params:
+                setattr(opt, k, tuple(params[k]))
+        if 'keywords' in params:
+            opt.keywords = list(params['keywords'])
+        if data is None and not opt.gs_input:
+            assert 'data_name' in params, "either data, data_name or bbox"
+
+        elapsed = dict()
+        with self.lock:
+            t0 = time.time()
+
+            # Input
+            mask = None
+            if data is not None:
+                scanner = make_scanner(mirror_border(data, opt), opt)
+            elif opt.gs_input:
+                scanner = make_forward_scanner(opt)
+                mask = make_skip_mask(opt)
+            else:
+                scanner = make_forward_scanner(opt, data_name=params['data_name'])
+            elapsed['input'] = time.time() - t0
+
+            # Forward scan
+            t = time.time()
+            output, aug_out = self.forward(self.models[opt.chkpt_num], scanner,
+                                           mask=mask)
+            elapsed['forward'] = time.time() - t
+
+            # Output
+            t = time.time()
+            if data is not None:
+                outputs = {k: get_output(output, opt, k) for k in output.data}
+            else:
+                outputs = None
+                save_output(output, opt, data_name=params.get('data_name'),
+                            aug_out=aug_out)
+            elapsed['output'] = time.time() - t
+            elapsed['total'] = time.time() - t0
+
+        print("Request latency: " +
+              ", ".join("{} {:.3f} s".format(k, v) for k, v in elapsed.items()))
+        return outputs, elapsed
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET  /status   Served models.
+    POST /forward  JSON request parameters, or a raw array as
+                   application/octet-stream with the parameters, `shape`
+                   (z,y,x) and `dtype` (uint8 is scaled to [0,1]) in the
+                   X-Params header. Raw arrays are answered with an .npz
+                   of the outputs, JSON requests with the elapsed time.
+    """
+    service = None
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        opt = self.service.opt
+        self.reply_json(200, dict(exp_name=opt.exp_name,
+                                  chkpt_nums=sorted(self.service.models),
+                                  scan_spec=opt.scan_spec))
+
+    def do_POST(self):
+        if self.path != '/forward':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Type') == 'application/octet-stream':
+                params = json.loads(self.headers.get('X-Params', '{}'))
+                data = np.frombuffer(body, dtype=params.get('dtype', 'uint8'))
+                data = data.reshape(params['shape'])
+                if data.dtype == np.uint8:
+                    data = (data/255.).astype('float32')
+                else:
+                    data = data.astype('float32')
+            else:
+                params = json.loads(body or b'{}')
+                data = None
+            outputs, elapsed = self.service(params, data=data)
+        except (AssertionError, KeyError, ValueError, TypeError) as e:
+            self.reply_json(400, dict(error=repr(e)))
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.reply_json(500, dict(error=repr(e)))
+            return
+
+        if outputs is None:
+            self.reply_json(200, dict(elapsed=elapsed))
+        else:
+            buf = io.BytesIO()
+            np.savez(buf, **outputs)
+            self.reply(200, buf.getvalue(), 'application/octet-stream',
+                       headers={'X-Elapsed': json.dumps(elapsed)})
+
+    def reply_json(self, code, obj):
+        self.reply(code, json.dumps(obj).encode(), 'application/json')
+
+    def reply(self, code, payload, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in (headers or dict()).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def serve(service, opt):
+    handler = type('ServiceHandler', (Handler,), dict(service=service))
+    if opt.unix_socket:
+        if os.path.exists(opt.unix_socket):
+            os.remove(opt.unix_socket)
+        server = UnixHTTPServer(opt.unix_socket, handler)
+        print("Serving on {}".format(opt.unix_socket))
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), handler)
+        print("Serving on http://{}:{}".format(opt.host, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # Options
+    opt = Options().parse()
+    assert not opt.out_of_core, "--out_of_core is not supported"
+    assert not opt.working_res, "--working_res is not supported"
+
+    # GPU
+    if not opt.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu_id
+        torch.backends.cudnn.benchmark = not opt.no_autotune
+
+    # Make directories.
+    if not os.path.isdir(opt.fwd_dir):
+        os.makedirs(opt.fwd_dir)
+
+    # Serve models.
+    print("Loading models: {} {}".format(opt.exp_name, opt.chkpt_nums))
+    serve(InferenceService(opt), opt)
@@ -0,0 +1,186 @@
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+import torch
+
+from deepem.test import fwd_utils
+from deepem.test.forward import Forward
+from deepem.test.option import Options
+from deepem.test.utils import load_model, make_forward_scanner, make_skip_mask
+
+
+def make_tasks(opt):
+    """
+    Split the --begin/--end region into blocks.
+
+    Each task owns a core block of the output layer (`core`, in output
+    voxel coordinates, x/y/z) and scans an input bbox (`bbox`, in mip 0
+    coordinates) extended by the FOV context and --block_margin. The bbox
+    is aligned to the scan grid of a single scan over the whole region, so
+    that its patches are a subset of that grid. With a margin of at least
+    the output patch size (the default), every patch overlapping the core
+    is scanned, and the core is blended exactly as in a single scan.
+    """
+    p = np.array([2**opt.in_mip, 2**opt.in_mip, 1])
+    b = np.array(opt.begin) // p
+    e = np.array(opt.end) // p
+    patch_offset = np.flip((np.array(opt.inputsz) - np.array(opt.outputsz))//2, 0)
+    inputsz = np.flip(np.array(opt.inputsz), 0)
+    size = np.array(opt.block_size)
+    margin = np.array(opt.block_margin)
+    stride = np.flip(np.array(opt.stride), 0)
+
+    # Output region
+    o0, o1 = b + patch_offset, e - patch_offset
+    assert all(o1 > o0)
+
+    tasks = list()
+    for x in range(o0[0], o1[0], size[0]):
+        for y in range(o0[1], o1[1], size[1]):
+            for z in range(o0[2], o1[2], size[2]):
+                c0 = np.array((x,y,z))
+                c1 = np.minimum(c0 + size, o1)
+                i0 = np.maximum(c0 - patch_offset - margin, b)
+                i1 = np.minimum(c1 + patch_offset + margin, e)
+                # Align to the global scan grid (patches at b + k*stride,
+                # and a last one ending at e).
+                i0 = b + (i0 - b) // stride * stride
+                n = np.maximum(-(-(i1 - i0 - inputsz) // stride), 0)
+                i1 = np.minimum(i0 + inputsz + n*stride, e)
+                # At least one input patch
+                i0 = np.maximum(np.minimum(i0, i1 - inputsz), b)
+                i1 = np.minimum(np.maximum(i1, i0 + inputsz), e)
+                core = (tuple(int(v) for v in c0), tuple(int(v) for v in c1))
+                bbox = (tuple(int(v) for v in i0*p), tuple(int(v) for v in i1*p))
+                tasks.append(dict(core=core, bbox=bbox))
+    return tasks
+
+
+def task_marker(opt, task):
+    c0, c1 = task['core']
+    name = '_'.join(['{}-{}'.format(b,e) for b,e in zip(c0,c1)])
+    return os.path.join(opt.task_dir, name + '.done')
+
+
+def create_layers(opt):
+    from deepem.test import cv_utils
+    p = np.array([2**opt.in_mip, 2**opt.in_mip, 1])
+    b = np.array(opt.begin) // p
+    e = np.array(opt.end) // p
+    patch_offset = np.flip((np.array(opt.inputsz) - np.array(opt.outputsz))//2, 0)
+    offset = cv_utils.get_offset(opt)
+    shape = tuple(int(v) for v in e - b - 2*patch_offset)
+
+    layers = dict()
+    for k, v in opt.scan_spec.items():
+        tag = k
+        if opt.tags is not None:
+            if tag in opt.tags:
+                tag = opt.tags[tag]
+        layers[k] = cv_utils.create_layer(opt, v[-4], opt.out_dtype, shape,
+                                          offset, tag=tag)
+    return layers
+
+
+def worker(rank, opt, layers, queue):
+    from deepem.test import cv_utils
+
+    # Device
+    if not opt.cpu:
+        opt.device = 'cuda:{}'.format(rank % torch.cuda.device_count())
+        torch.backends.cudnn.benchmark = not opt.no_autotune
+
+    model = load_model(opt)
+    forward = Forward(opt)
+
+    p = np.array([2**opt.in_mip, 2**opt.in_mip, 1])
+    patch_offset = np.flip((np.array(opt.inputsz) - np.array(opt.outputsz))//2, 0)
+
+    for task in iter(queue.get, None):
+        t0 = time.time()
+        opt.begin, opt.end = task['bbox']
+        opt.center = None
+        print("[worker {}] task: {}".format(rank, task))
+        scanner = make_forward_scanner(opt)
+        output, _ = forward(model, scanner, mask=make_skip_mask(opt))
+
+        # Write out the core block.
+        c0, c1 = [np.array(c) for c in task['core']]
+        origin = np.array(task['bbox'][0]) // p + patch_offset
+        x0, y0, z0 = c0 - origin
+        x1, y1, z1 = c1 - origin
+        for k in output.data:
+            data = output.get_data(k)[:,z0:z1,y0:y1,x0:x1]
+            data = fwd_utils.quantize(data, opt.out_dtype)
+            cv_utils.write(data, layers[k], task['core'][0], opt)
+
+        # Completion marker
+        with open(task_marker(opt, task), 'w') as f:
+            f.write('{:.3f}\n'.format(time.time() - t0))
+        print("[worker {}] done: {:.3f} s".format(rank, time.time() - t0))
+
+
+def run(opt):
+    tasks = make_tasks(opt)
+    pending = [t for t in tasks if not os.path.exists(task_marker(opt, t))]
+    print("{}/{} tasks remaining".format(len(pending), len(tasks)))
+
+    layers = create_layers(opt)
+
+    # Local worker pool
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    for task in pending:
+        queue.put(task)
+    num_workers = min(opt.num_workers, len(pending))
+    for _ in range(num_workers):
+        queue.put(None)
+
+    workers = list()
+    for rank in range(num_workers):
+        w = ctx.Process(target=worker, args=(rank, opt, layers, queue))
+        w.start()
+        workers.append(w)
+    for w in workers:
+        w.join()
+
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        raise RuntimeError("{} worker(s) failed; rerun to resume".format(len(failed)))
+
+    # Downsample
+    if opt.downsample:
+        from deepem.test import cv_utils
+        for gs_path in layers.values():
+            cv_utils.downsample(gs_path, opt)
+
+
+if __name__ == "__main__":
+    # Options
+    opt = Options().parse()
+    assert opt.gs_input and opt.gs_output, "sharding requires cloud-volume I/O"
+    assert opt.block_size is not None
+    assert opt.begin is not None and opt.end is not None
+    assert all(b % 2**opt.in_mip == 0 for b in opt.begin[:2])
+    assert opt.center is None and opt.offset is None
+    assert not (opt.crop_border or opt.crop_center or opt.variance)
+    assert not opt.out_of_core, "--out_of_core is not supported"
+    assert not opt.working_res, "--working_res is not supported"
+    assert all(s % c == 0 for s, c in zip(opt.block_size, opt.chunk_size)), \
+        "--block_size must be a multiple of --chunk_size"
+
+    # GPU
+    if not opt.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu_id
+
+    # Make directories.
+    if opt.task_dir is None:
+        opt.task_dir = os.path.join(opt.fwd_dir, 'tasks')
+    if not os.path.isdir(opt.task_dir):
+        os.makedirs(opt.task_dir)
+
+    # Run inference.
+    print("Running sharded inference: {}".format(opt.exp_name))
+    run(opt)
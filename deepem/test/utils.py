@@ -1,75 +1,270 @@
+import copy
 import imp
 import numpy as np
 import os
 from types import SimpleNamespace
 
+import torch
+from torch import nn
+
 from dataprovider3 import Dataset, ForwardScanner, emio
 
-from deepem.test.model import Model
+from deepem.test import fwd_utils
+from deepem.test.model import Model, Ensemble
 from deepem.utils import py_utils
 
 
 def load_model(opt):
+    # Up/down models at their working resolution
+    set_working_res(opt)
+
+    # Ensemble of checkpoints
+    if opt.ensemble:
+        models = list()
+        for model_dir, chkpt_num in opt.ensemble:
+            member = copy.copy(opt)
+            member.model_dir = model_dir
+            member.chkpt_num = chkpt_num
+            member.ensemble = None
+            models.append(load_model(member))
+        print("ENSEMBLE: {} models".format(len(models)))
+        return Ensemble(models, opt)
+
     # Create a model.
     mod = imp.load_source('model', opt.model)
-    model = Model(mod.create_model(opt), opt)
+    net = mod.create_model(opt)
+    if opt.working_res:
+        assert strip_updown(net) == opt.working_factor
+    model = Model(net, opt)
 
     # Load from a checkpoint, if any.
     if opt.chkpt_num > 0:
         model = load_chkpt(model, opt.model_dir, opt.chkpt_num)
 
     model = model.train() if opt.no_eval else model.eval()
-    return model.to(opt.device)
+    model = model.to(opt.device)
+
+    # Fold batch normalization into convolutions (eval mode only).
+    if not (opt.no_eval or opt.no_fold):
+        from deepem.test.fold import fold_batchnorm
+        print("FOLD: {} layers".format(fold_batchnorm(model)))
+
+    # Optional reduced precision
+    if opt.precision != 'fp32':
+        from deepem.test import precision
+        model = precision.reduce_precision(model, opt)
+
+    # Optional compiled inference graph
+    if opt.compile:
+        model = compile_model(model, opt)
+    return model
+
+
+def set_working_res(opt):
+    """
+    Run an up/down model without its down/up blocks, i.e. at the
+    resolution its core works at. Scales the specs, stride, crops and
+    mirroring down by the scale factor of the model (once per `opt`).
+
+    Inputs are then read from the next mip(s) of --gs_input, or
+    downsampled on the host (see `read_input`). Outputs are written at the
+    working resolution ('native', with the layer resolution scaled up), or
+    upsampled at write time ('upsample', see `get_output`).
+    """
+    if not opt.working_res or opt.working_factor is not None:
+        return
+    mod = imp.load_source('model', opt.model)
+    factor = strip_updown(mod.create_model(opt))
+    print("WORKING RESOLUTION: 1/{}".format(factor))
+    f = np.array(factor)
+
+    def down(v):
+        v = np.array(v)
+        assert all(v % f == 0), "{} not divisible by {}".format(tuple(v), factor)
+        return tuple(int(x) for x in v // f)
+
+    opt.fov = down(opt.fov)
+    opt.inputsz = down(opt.inputsz)
+    opt.outputsz = down(opt.outputsz)
+    for spec in ['in_spec','out_spec','scan_spec']:
+        scaled = {k: tuple(v[:-3]) + down(v[-3:]) for k, v in getattr(opt, spec).items()}
+        setattr(opt, spec, scaled)
+    opt.stride = down(opt.stride)
+    opt.overlap = tuple(o - s for o, s in zip(opt.outputsz, opt.stride))
+    opt.scan_params = dict(opt.scan_params, stride=opt.stride)
+    for k in ['mirror','crop_border','crop_center','force_crop']:
+        if getattr(opt, k) is not None:
+            setattr(opt, k, down(getattr(opt, k)))
+
+    # Cloud-volume input from the next mip(s) (2x2x1 mip pyramid)
+    if opt.gs_input:
+        mips = int(np.log2(factor[-1]))
+        assert factor[0] == 1 and factor[-2] == factor[-1] == 2**mips
+        opt.in_mip += mips
+        if opt.skip_mip is not None:
+            assert opt.skip_mip >= opt.in_mip
+
+    # Output layer resolution (x,y,z)
+    if opt.working_res == 'native':
+        opt.resolution = tuple(r*s for r, s in zip(opt.resolution, factor[::-1]))
+    opt.working_factor = factor
+
+
+def strip_updown(net):
+    """
+    Replace the down (AvgPool3d) and up (nn.Upsample) blocks of an up/down
+    model (`models/updown*.py`) by identities. Returns the scale factor.
+    """
+    down = [m for m in getattr(net, 'down', nn.Identity()).children()]
+    up = [m for m in getattr(net, 'up', nn.Identity()).children()]
+    if not (len(down) == 1 and isinstance(down[0], nn.AvgPool3d) and up and
+            all(isinstance(m, nn.Upsample) for m in up)):
+        raise ValueError("--working_res requires an up/down model")
+    factor = tuple(down[0].kernel_size)
+    assert tuple(down[0].stride) == factor
+    assert all(tuple(m.scale_factor) == factor for m in up)
+    net.down = nn.Identity()
+    net.up = nn.Identity()
+    return tuple(int(x) for x in factor)
+
+
+def compile_model(model, opt):
+    """
+    Compile the model together with its output head (narrowing, sigmoid,
+    precomputed mask and crop) into a single inference graph.
+    """
+    print("COMPILE: {}".format(opt.compile))
+    if opt.compile == 'compile':
+        return torch.compile(model)
+
+    # TorchScript trace with a full batch
+    assert opt.compile == 'trace'
+    num_variants = len(opt.test_aug) if opt.patch_aug else 1
+    n = opt.batch_size * num_variants
+    sample = {k: torch.zeros((n,) + tuple(v), device=opt.device)
+              for k, v in opt.in_spec.items()}
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (sample,), strict=False)
+    if opt.no_eval:
+        return traced
+    return torch.jit.freeze(traced)
 
 
 def load_chkpt(model, fpath, chkpt_num):
-    print("LOAD CHECKPOINT: {} iters.".format(chkpt_num))
+    # Prefer an inference-only checkpoint, if exported after the checkpoint.
     fname = os.path.join(fpath, "model{}.chkpt".format(chkpt_num))
+    infer = get_infer_fpath(fpath, chkpt_num)
+    if os.path.exists(infer):
+        if os.path.exists(fname) and os.path.getmtime(fname) > os.path.getmtime(infer):
+            print("WARNING: {} is older than {}, ignored".format(infer, fname))
+        else:
+            print("LOAD INFERENCE CHECKPOINT: {} iters.".format(chkpt_num))
+            model.load_inference(infer)
+            return model
+
+    print("LOAD CHECKPOINT: {} iters.".format(chkpt_num))
     model.load(fname)
     return model
 
 
+def get_infer_fpath(fpath, chkpt_num):
+    return os.path.join(fpath, "model{}.infer".format(chkpt_num))
+
+
 def make_forward_scanner(opt, data_name=None):
     # Cloud-volume
     if opt.gs_input:
         try:
             from deepem.test import cv_utils
-            img = cv_utils.cutout(opt, opt.gs_input, dtype='uint8')
-
-            # Optional input histogram normalization 
-            if opt.gs_input_norm:
-                assert len(opt.gs_input_norm) == 2
-                low, high = opt.gs_input_norm
-                img = normalize_per_slice(img, lowerfract=low, upperfract=high)
-            
-            # [0, 255] -> [0.0, 1.0]
-            img = (img/255.).astype('float32')
-
-            # Optional input mask
-            if opt.gs_input_mask:
-                try:
-                    msk = cv_utils.cutout(opt, opt.gs_input_mask, dtype='uint8')
-                    img[msk > 0] = 0
-                except:
-                    raise
+            if opt.stream_input:
+                img = make_stream_input(opt)
+            else:
+                img = cv_utils.cutout(opt, opt.gs_input, dtype='uint8')
+
+                # Optional input mask
+                if opt.gs_input_mask:
+                    try:
+                        msk = cv_utils.cutout(opt, opt.gs_input_mask, dtype='uint8')
+                    except:
+                        raise
+                else:
+                    msk = None
+
+                img = preprocess(img, opt, msk=msk)
 
         except ImportError:
             raise
     else:
         assert data_name is not None
         print(data_name)
-        # Read an EM image.
-        if opt.dummy:
-            img = np.random.rand(*opt.dummy_inputsz[-3:]).astype('float32')
-        else:
-            fpath = os.path.join(opt.data_dir, data_name, opt.input_name)
-            img = emio.imread(fpath)
-            img = (img/255.).astype('float32')
+        img = read_input(opt, data_name)
 
         # Border mirroring
-        if opt.mirror:
+        img = mirror_border(img, opt)
+
+    return make_scanner(img, opt, data_name=data_name)
+
+
+def read_input(opt, data_name):
+    """Read an EM image, scaled to [0,1]."""
+    if opt.dummy:
+        img = np.random.rand(*opt.dummy_inputsz[-3:]).astype('float32')
+    else:
+        fpath = os.path.join(opt.data_dir, data_name, opt.input_name)
+        img = emio.imread(fpath)
+        img = (img/255.).astype('float32')
+
+    # Up/down models at their working resolution
+    if opt.working_factor is not None:
+        img = downsample_input(img, opt.working_factor)
+    return img
+
+
+def downsample_input(img, factor):
+    """Average-pool a (z,y,x) volume, as the `DownBlock` of up/down models."""
+    shape = [s//f for s, f in zip(img.shape, factor)]
+    img = img[tuple(slice(0, s*f) for s, f in zip(shape, factor))]
+    img = img.reshape(shape[0], factor[0], shape[1], factor[1], shape[2], factor[2])
+    return img.mean(axis=(1,3,5), dtype=np.float32)
+
+
+def mirror_border(img, opt):
+    if opt.mirror:
+        if opt.block_scan:
+            # Virtual padding, resolved per patch by BlockScanner
+            from deepem.test.volume import MirrorVolume
+            img = MirrorVolume(img, [x//2 for x in opt.mirror])
+        else:
+            # ForwardScanner datasets are numpy arrays: padded copy
             pad_width = [(x//2,x//2) for x in opt.mirror]
             img = np.pad(img, pad_width, 'reflect')
+    return img
+
+
+def make_scanner(img, opt, data_name=None):
+    """Forward scanner of a preprocessed input volume."""
+    # BlockScanner
+    if opt.block_scan:
+        from deepem.test.scanner import BlockScanner
+        from deepem.test.writer import ArrayWriter, H5Writer
+        # Outputs to be upsampled are quantized after upsampling (get_output)
+        dtype = 'float32' if opt.working_res == 'upsample' else opt.out_dtype
+        if opt.out_of_core and opt.gs_output:
+            from deepem.test import cv_utils
+            writer = lambda k, shape: cv_utils.make_writer(opt, shape, dtype,
+                                                           tag=get_tag(opt, k))
+        elif opt.out_of_core:
+            chunks = (1,) + tuple(opt.stride)
+            writer = lambda k, shape: H5Writer(get_fpath(opt, data_name, k), shape,
+                                               dtype=dtype, chunks=chunks,
+                                               compress=opt.h5_compress)
+        else:
+            writer = lambda k, shape: ArrayWriter(shape, dtype=dtype)
+        device = opt.device if opt.device_blend else None
+        return BlockScanner({'input': img}, opt.in_spec, opt.scan_spec,
+                            opt.stride, writer, crop_border=opt.crop_border,
+                            crop_center=opt.crop_center, device=device,
+                            dtype=dtype)
 
     # ForwardScanner
     dataset = Dataset(spec=opt.in_spec)
@@ -77,102 +272,224 @@ def make_forward_scanner(opt, data_name=None):
     return ForwardScanner(dataset, opt.scan_spec, **opt.scan_params)
 
 
+def make_stream_input(opt):
+    """Cloud-volume input, fetched & preprocessed lazily in z-slabs."""
+    from deepem.test import cv_utils
+    from deepem.test.volume import SlabVolume
+
+    cvol, sl = cv_utils.open_cutout(opt, opt.gs_input)
+    if opt.gs_input_mask:
+        mvol, msl = cv_utils.open_cutout(opt, opt.gs_input_mask)
+
+    def fetch(z0, z1):
+        img = cv_utils.cutout_slab(cvol, sl, z0, z1, dtype='uint8')
+        if opt.gs_input_mask:
+            msk = cv_utils.cutout_slab(mvol, msl, z0, z1, dtype='uint8')
+        else:
+            msk = None
+        return preprocess(img, opt, msk=msk)
+
+    return SlabVolume(fetch, cv_utils.cutout_shape(sl), opt.stride[0])
+
+
+def make_skip_mask(opt):
+    """
+    Coarse validity mask for --skip_empty, read from --gs_input_mask at
+    --skip_mip. Nonzero mask voxels are masked out.
+    """
+    if not (opt.skip_empty and opt.skip_mip is not None):
+        return None
+
+    from deepem.test import cv_utils
+    from deepem.test.volume import CoarseMask
+
+    _, sl = cv_utils.open_cutout(opt, opt.gs_input_mask)
+    cvol, csl = cv_utils.open_cutout(opt, opt.gs_input_mask, mip=opt.skip_mip)
+    msk = cvol[csl].transpose([3,2,1,0])[0]
+
+    # Scanned volume (in_mip) to mask (skip_mip) coordinates
+    f = 2**(opt.skip_mip - opt.in_mip)
+    factor = (1, f, f)
+    origin = [s.start - c.start*r for s, c, r in zip(sl[2::-1], csl[2::-1], factor)]
+    return CoarseMask(msk == 0, factor, origin=origin)
+
+
+def preprocess(img, opt, msk=None):
+    """Preprocess a uint8 cloud-volume input (or z-slab of it)."""
+    # Optional input histogram normalization
+    if opt.gs_input_norm:
+        assert len(opt.gs_input_norm) == 2
+        low, high = opt.gs_input_norm
+        img = normalize_per_slice(img, lowerfract=low, upperfract=high,
+                                  num_threads=opt.norm_threads, inplace=True)
+
+    # [0, 255] -> [0.0, 1.0]
+    img = (img/255.).astype('float32')
+
+    # Optional input mask
+    if msk is not None:
+        img[msk > 0] = 0
+
+    return img
+
+
 def save_output(output, opt, data_name=None, aug_out=None):
-    for k in output.data:
-        data = output.get_data(k)
+    # Out-of-core outputs have already been written block by block.
+    if opt.out_of_core:
+        output.close()
+        return
 
-        # Crop
-        if opt.crop_border:
-            data = py_utils.crop_border(data, opt.crop_border)
-        if opt.crop_center:
-            data = py_utils.crop_center(data, opt.crop_center)
+    for k in output.data:
+        data = get_output(output, opt, k)
 
         # Cloud-volume
         if opt.gs_output:
             try:
-                tag = k
-                if opt.tags is not None:
-                    if tag in opt.tags:
-                        tag = opt.tags[tag]
+                tag = get_tag(opt, k)
 
                 from deepem.test import cv_utils
                 cv_utils.ingest(data, opt, tag=tag)
 
                 # Optional variance
                 if aug_out is not None:
-                    variance = np.var(np.stack(aug_out[k]), axis=0)
+                    variance = aug_out[k].variance()
                     cv_utils.ingest(variance, opt, tag=(tag + '_var'))
 
             except ImportError:
                 raise
+        elif opt.h5_chunked:
+            # Chunks aligned to the scan stride
+            from deepem.test.writer import write_chunked
+            chunks = (1,) + tuple(opt.stride)
+            write_chunked(get_fpath(opt, data_name, k), data, chunks,
+                          compress=opt.h5_compress, num_threads=opt.h5_threads)
         else:
-            dname = data_name.replace('/', '_')
-            fname = "{}_{}_{}".format(dname, k, opt.chkpt_num)
-            if opt.out_prefix:
-                fname = opt.out_prefix + '_' + fname
-            if opt.out_tag:
-                fname = fname + '_' + opt.out_tag
-            fpath = os.path.join(opt.fwd_dir, fname + ".h5")
-            emio.imsave(data, fpath)
+            emio.imsave(data, get_fpath(opt, data_name, k))
+
+
+def get_tag(opt, key):
+    """Output layer tag of `key`."""
+    tag = key
+    if opt.tags is not None:
+        if tag in opt.tags:
+            tag = opt.tags[tag]
+        # Ensemble variance
+        elif tag.endswith('_var') and tag[:-4] in opt.tags:
+            tag = opt.tags[tag[:-4]] + '_var'
+    return tag
+
 
+def get_output(output, opt, key):
+    """Cropped & quantized output."""
+    data = output.get_data(key)
 
-def histogram_per_slice(img):    
+    # Crop (BlockScanner outputs are already cropped)
+    if opt.crop_border and not opt.block_scan:
+        data = py_utils.crop_border(data, opt.crop_border)
+    if opt.crop_center and not opt.block_scan:
+        data = py_utils.crop_center(data, opt.crop_center)
+
+    # Up/down models: upsample from the working resolution
+    if opt.working_res == 'upsample':
+        data = fwd_utils.upsample(data, opt.working_factor)
+
+    # Optional quantization
+    return fwd_utils.quantize(data, opt.out_dtype)
+
+
+def get_fpath(opt, data_name, key):
+    dname = data_name.replace('/', '_')
+    fname = "{}_{}_{}".format(dname, key, opt.chkpt_num)
+    if opt.out_prefix:
+        fname = opt.out_prefix + '_' + fname
+    if opt.out_tag:
+        fname = fname + '_' + opt.out_tag
+    return os.path.join(opt.fwd_dir, fname + ".h5")
+
+
+def histogram_per_slice(img, num_threads=1):
+    """Per-slice histograms (z, 255 or 256) of a uint8 volume."""
     z = img.shape[-3]
-    xy = img.shape[-2] * img.shape[-1]
-    return np.apply_along_axis(np.bincount, axis=1, arr=img.reshape((z,xy)),
-                               minlength=255)
+    nbins = 256 if img.max() == 255 else 255
+    hist = np.empty((z, nbins), dtype=np.int64)
+
+    def count(i):
+        hist[i] = 0
+        for rows in row_blocks(img[i]):
+            hist[i] += np.bincount(img[i,rows].ravel(), minlength=nbins)
+
+    parallel_for(count, range(z), num_threads)
+    return hist
+
 
+def find_section_clamping_values(hist, lowerfract, upperfract):
+    """Find int8 values that correspond to lowerfract & upperfract of zlevel histogram(s)
 
-def find_section_clamping_values(zlevel, lowerfract, upperfract):
-    """Find int8 values that correspond to lowerfract & upperfract of zlevel histogram
-    
     From igneous (https://github.com/seung-lab/igneous/blob/master/igneous/tasks/tasks.py#L547)
+    Vectorized over z-sections if `hist` has one histogram per row.
     """
-    filtered = np.copy(zlevel)
+    zlevels = np.atleast_2d(hist)
+    filtered = np.copy(zlevels)
 
     # remove pure black from frequency counts as
     # it has no information in our images
-    filtered[0] = 0
+    filtered[:,0] = 0
 
-    cdf = np.zeros(shape=(len(filtered),), dtype=np.uint64)
-    cdf[0] = filtered[0]
-    for i in range(1, len(filtered)):
-        cdf[i] = cdf[i - 1] + filtered[i]
+    cdf = np.cumsum(filtered, axis=1)
+    total = cdf[:,-1]
+    ratio = cdf / np.maximum(total, 1)[:,None].astype(np.float64)
 
-    total = cdf[-1]
-
-    if total == 0:
-        return (0, 0)
-
-    lower = 0
-    for i, val in enumerate(cdf):
-        if float(val) / float(total) > lowerfract:
-            break
-        lower = i
-
-    upper = 0
-    for i, val in enumerate(cdf):
-        if float(val) / float(total) > upperfract:
-            break
-        upper = i
+    def clamp(fract):
+        # Bin before the first one whose cdf exceeds fract
+        above = ratio > fract
+        first = np.where(above.any(axis=1), above.argmax(axis=1), ratio.shape[1])
+        return np.where(total > 0, np.maximum(first - 1, 0), 0)
 
+    lower, upper = clamp(lowerfract), clamp(upperfract)
+    if np.ndim(hist) == 1:
+        return (int(lower[0]), int(upper[0]))
     return (lower, upper)
 
 
-def normalize_per_slice(img, lowerfract=0.01, upperfract=0.01):
+def normalize_per_slice(img, lowerfract=0.01, upperfract=0.01, num_threads=1,
+                        inplace=False):
+    """
+    Per-slice histogram normalization of a uint8 volume. The float32
+    rescale is evaluated once per slice on a 256-entry lookup table.
+    """
     maxval = 255.
-    hist = histogram_per_slice(img)
-    img = img.astype(np.float32)
-    for z in range(img.shape[-3]):
-        lower, upper = find_section_clamping_values(hist[z], 
-                                                lowerfract=lowerfract, 
-                                                upperfract=1-upperfract)
+    hist = histogram_per_slice(img, num_threads=num_threads)
+    lowers, uppers = find_section_clamping_values(hist, lowerfract=lowerfract,
+                                                  upperfract=1-upperfract)
+    out = img if inplace else np.empty_like(img)
+    values = np.arange(256, dtype=np.float32)
+
+    def rescale(z):
+        lower, upper = lowers[z], uppers[z]
         if lower == upper:
-            continue
+            if not inplace:
+                out[z] = img[z]
+            return
+        lut = (values - float(lower)) * (maxval / (float(upper) - float(lower)))
+        lut = np.clip(np.round(lut), 0., maxval).astype(np.uint8)
+        for rows in row_blocks(img[z]):
+            np.take(lut, img[z,rows], out=out[z,rows])
 
-        im = img[z,:,:]
-        im = (im - float(lower)) * (maxval / (float(upper) - float(lower)))
-        img[z,:,:] = im
+    parallel_for(rescale, range(img.shape[-3]), num_threads)
+    return out
 
-    img = np.round(img)
-    return np.clip(img, 0., maxval).astype(np.uint8)
\ No newline at end of file
+
+def row_blocks(img2d, block=2**16):
+    """Cache-sized row blocks of a 2D image."""
+    rows = max(block // img2d.shape[-1], 1)
+    return [slice(r, r + rows) for r in range(0, img2d.shape[-2], rows)]
+
+
+def parallel_for(func, iterable, num_threads=1):
+    if num_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(func, iterable))
+    else:
+        for x in iterable:
+            func(x)
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class SlabVolume(object):
+    """
+    Lazily loaded 3D volume, fetched in z-slabs.
+
+    Slabs are fetched on demand and the next slab is prefetched on a
+    background thread while the current one is being consumed. Slabs
+    below the most recent request are released, so the volume should be
+    read in z-major order, e.g. by `BlockScanner`.
+    """
+    def __init__(self, fetch, shape, slab, dtype='float32'):
+        """
+        Args:
+            fetch: Callable (z0, z1) -> numpy array of shape (z1-z0, y, x).
+            shape: Volume shape (z, y, x).
+            slab:  Slab depth.
+            dtype: Data type of the fetched slabs.
+        """
+        assert len(shape) == 3
+        assert slab > 0
+        self.fetch = fetch
+        self.shape = tuple(shape)
+        self.slab = slab
+        self.dtype = np.dtype(dtype)
+        self.ndim = 3
+
+        self.num_slabs = (self.shape[0] - 1)//slab + 1
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.slabs = dict()
+        self.prefetch(0)
+
+    def __getitem__(self, slices):
+        zs, ys, xs = slices
+        assert 0 <= zs.start < zs.stop <= self.shape[0]
+        i0 = zs.start // self.slab
+        i1 = (zs.stop - 1) // self.slab
+
+        # Release slabs that will not be read again.
+        for i in [i for i in self.slabs if i < i0]:
+            del self.slabs[i]
+
+        parts = list()
+        for i in range(i0, i1 + 1):
+            data = self.get_slab(i)
+            z0 = max(zs.start - i*self.slab, 0)
+            z1 = min(zs.stop - i*self.slab, data.shape[0])
+            parts.append(data[z0:z1,ys,xs])
+        self.prefetch(i1 + 1)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def get_slab(self, i):
+        self.prefetch(i)
+        return self.slabs[i].result()
+
+    def prefetch(self, i):
+        if i < self.num_slabs and i not in self.slabs:
+            z0 = i*self.slab
+            z1 = min(z0 + self.slab, self.shape[0])
+            self.slabs[i] = self.executor.submit(self.fetch, z0, z1)
+
+
+class CoarseMask(object):
+    """
+    Validity mask of a scanned volume, stored at a coarser resolution.
+
+    Each mask voxel covers `factor` (z,y,x) voxels of the scanned volume,
+    whose origin lies at `origin` within the first mask voxel.
+    """
+    def __init__(self, valid, factor, origin=(0,0,0)):
+        self.valid = np.asarray(valid, dtype=bool)
+        self.factor = np.array(factor)
+        self.origin = np.array(origin)
+
+    def empty(self, begin, end):
+        """Whether the box [begin, end) has no valid voxel."""
+        b = (np.array(begin) + self.origin) // self.factor
+        e = -((-(np.array(end) + self.origin)) // self.factor)
+        slices = tuple(slice(int(x), int(y)) for x, y in zip(b, e))
+        return not np.any(self.valid[slices])
+
+
+class MirrorVolume(object):
+    """
+    Virtually mirror-padded 3D volume, equivalent to
+    `np.pad(data, [(p,p) for p in pad], 'reflect')`.
+
+    Boxes inside the original volume are read straight from it; only
+    boxes touching the padded border gather reflected coordinates.
+    """
+    def __init__(self, data, pad):
+        assert len(pad) == 3
+        assert all(0 <= p < s for p, s in zip(pad, data.shape[-3:]))
+        self.data = data
+        self.pad = tuple(int(p) for p in pad)
+        self.shape = tuple(s + 2*p for s, p in zip(data.shape[-3:], self.pad))
+        self.dtype = data.dtype
+        self.ndim = 3
+
+    def __getitem__(self, slices):
+        assert len(slices) == 3
+        ranges = [(s.start - p, s.stop - p) for s, p in zip(slices, self.pad)]
+
+        # Interior
+        if all(0 <= b and e <= n for (b, e), n in zip(ranges, self.data.shape)):
+            return self.data[tuple(slice(b, e) for b, e in ranges)]
+
+        # Border: reflect coordinates, then gather from their bounding box.
+        indices = list()
+        for (b, e), n in zip(ranges, self.data.shape):
+            idx = np.abs(np.arange(b, e))
+            idx = np.where(idx < n, idx, 2*(n - 1) - idx)
+            indices.append(idx)
+        box = tuple(slice(int(i.min()), int(i.max()) + 1) for i in indices)
+        data = self.data[box]
+        return data[np.ix_(*[i - s.start for i, s in zip(indices, box)])]
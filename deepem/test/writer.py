@@ -0,0 +1,116 @@
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+
+class ArrayWriter(object):
+    """
+    Write output blocks into an in-memory array.
+    """
+    def __init__(self, shape, dtype='float32'):
+        self.data = np.zeros(shape, dtype=dtype)
+
+    def write(self, begin, data):
+        """Write a 4D block whose first voxel is at `begin` (z,y,x)."""
+        zs, ys, xs = [slice(b, b + s) for b, s in zip(begin, data.shape[-3:])]
+        self.data[:,zs,ys,xs] = data
+
+    def close(self):
+        pass
+
+
+class H5Writer(object):
+    """
+    Write output blocks into a chunked HDF5 dataset.
+    """
+    def __init__(self, fpath, shape, dtype='float32', chunks=True, compress=None):
+        print("Create {}: {}".format(fpath, shape))
+        if chunks is not True:
+            chunks = tuple(min(c, s) for c, s in zip(chunks, shape))
+        codec = Codec(compress, np.dtype(dtype).itemsize)
+        self.f = h5py.File(fpath, 'w')
+        self.dset = self.f.create_dataset('/main', shape, dtype=dtype,
+                                          chunks=chunks, **codec.filters)
+
+    def write(self, begin, data):
+        """Write a 4D block whose first voxel is at `begin` (z,y,x)."""
+        zs, ys, xs = [slice(b, b + s) for b, s in zip(begin, data.shape[-3:])]
+        self.dset[:,zs,ys,xs] = data
+
+    def close(self):
+        self.f.close()
+
+
+def write_chunked(fpath, data, chunks, compress=None, num_threads=1):
+    """
+    Write an array into a chunked, optionally compressed HDF5 dataset.
+    Chunks are compressed on a thread pool and written as is with
+    `write_direct_chunk`, bypassing the (single-threaded) HDF5 filters.
+    """
+    chunks = tuple(min(c, s) for c, s in zip(chunks, data.shape))
+    codec = Codec(compress, data.dtype.itemsize)
+    grid = [range(0, s, c) for s, c in zip(data.shape, chunks)]
+
+    def compress_chunk(offset):
+        src = tuple(slice(o, o + c) for o, c in zip(offset, chunks))
+        chunk = data[src]
+        # Edge chunks are stored at full size.
+        if chunk.shape != chunks:
+            padded = np.zeros(chunks, dtype=data.dtype)
+            padded[tuple(slice(0, s) for s in chunk.shape)] = chunk
+            chunk = padded
+        return offset, codec.compress(np.ascontiguousarray(chunk))
+
+    with h5py.File(fpath, 'w') as f:
+        dset = f.create_dataset('/main', data.shape, dtype=data.dtype,
+                                chunks=chunks, **codec.filters)
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for offset, buf in executor.map(compress_chunk, itertools.product(*grid)):
+                dset.id.write_direct_chunk(offset, buf)
+
+
+class Codec(object):
+    """
+    HDF5 compression: 'gzip' (built-in deflate with byte shuffle), or
+    'lz4'/'zstd' (Blosc, requires `hdf5plugin` and `blosc`), with an
+    optional level, e.g. 'gzip:4'. The filter pipeline of a dataset and the
+    equivalent chunk compressor for direct chunk writes.
+    """
+    def __init__(self, compress, itemsize):
+        self.name, _, level = (compress or 'none').partition(':')
+        self.itemsize = itemsize
+        if self.name == 'none':
+            self.filters = dict()
+        elif self.name == 'gzip':
+            self.level = int(level) if level else 1
+            self.filters = dict(compression='gzip', compression_opts=self.level,
+                                shuffle=(itemsize > 1))
+        elif self.name in ['lz4','zstd']:
+            try:
+                import blosc
+                import hdf5plugin
+            except ImportError:
+                raise ImportError("{} compression requires hdf5plugin and "
+                                  "blosc".format(self.name))
+            self.level = int(level) if level else 5
+            self.filters = dict(hdf5plugin.Blosc(cname=self.name, clevel=self.level,
+                                                 shuffle=hdf5plugin.Blosc.SHUFFLE))
+        else:
+            raise ValueError("unknown compression: {}".format(compress))
+
+    def compress(self, chunk):
+        """Compress a C-contiguous chunk as the filter pipeline would."""
+        if self.name == 'none':
+            return chunk.tobytes()
+        if self.name == 'gzip':
+            buf = chunk.view(np.uint8).reshape(-1, self.itemsize)
+            if self.itemsize > 1:
+                buf = buf.T.copy()  # Byte shuffle
+            return zlib.compress(buf.tobytes(), self.level)
+        import blosc
+        return blosc.compress(chunk.tobytes(), typesize=self.itemsize,
+                              clevel=self.level, shuffle=blosc.SHUFFLE,
+                              cname=self.name)